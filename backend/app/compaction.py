@@ -0,0 +1,117 @@
+import logging
+import os
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+METHODS = ("pca", "truncate")
+
+_cache = {}
+_fit_lock = threading.Lock()
+
+
+class Projection:
+    """
+    Dimension reduction applied to every vector of a collection, at index and at query time. Projected
+    vectors are normalized again, so that distances keep the scale of the original normalized embeddings.
+    """
+
+    def __init__(self, method, dimensions, mean=None, components=None):
+        self.method = method
+        self.dimensions = dimensions
+        self.mean = mean
+        self.components = components
+
+    def apply(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.method == "pca":
+            vectors = (vectors - self.mean) @ self.components.T
+        else:
+            vectors = vectors[:, :self.dimensions]
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        arrays = {"method": np.array(self.method), "dimensions": np.array(self.dimensions)}
+        if self.method == "pca":
+            arrays.update(mean=self.mean, components=self.components)
+        # Written aside and renamed, so that readers never load a partial file
+        temp_path = f"{path}.tmp.npz"
+        np.savez(temp_path, **arrays)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            method = str(arrays["method"])
+            if method == "pca":
+                return cls(method, int(arrays["dimensions"]), arrays["mean"], arrays["components"])
+            return cls(method, int(arrays["dimensions"]))
+
+
+def fit_projection(method, dimensions, vectors):
+    """Fits a projection on a sample of vectors: principal components for "pca", the first dimensions for "truncate"."""
+    if method not in METHODS:
+        raise ValueError(f"Unknown compaction method: {method}")
+    vectors = np.asarray(vectors, dtype=np.float32)
+    dimensions = min(dimensions, vectors.shape[1])
+    if method == "truncate":
+        return Projection(method, dimensions)
+    mean = vectors.mean(axis=0)
+    # Right singular vectors are the principal components, by decreasing variance
+    _, _, components = np.linalg.svd(vectors - mean, full_matrices=False)
+    # With fewer samples than dimensions, there are only as many components as samples
+    return Projection(method, min(dimensions, len(components)), mean, components[:dimensions].astype(np.float32))
+
+
+def projection_path(name, directory):
+    return os.path.join(directory, f"{name}.npz")
+
+
+def get_projection(name, directory):
+    """
+    Returns the projection of a logical collection stored in directory, or None when it stores full vectors.
+    Reloaded when the file changes.
+    """
+    path = projection_path(name, directory)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        _cache.pop(path, None)
+        return None
+    cached = _cache.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, Projection.load(path))
+        _cache[path] = cached
+    return cached[1]
+
+
+def fit_and_save(name, method, dimensions, vectors, directory):
+    """
+    Fits the projection of a logical collection and saves it, unless another indexing job saved one
+    first, in which case that one is returned so that all the vectors share the same space.
+    """
+    with _fit_lock:
+        projection = get_projection(name, directory)
+        if projection is None:
+            projection = fit_projection(method, dimensions, vectors)
+            projection.save(projection_path(name, directory))
+            logger.info(f"Fitted {method} projection of {name} to {projection.dimensions} dimensions "
+                        f"on {len(vectors)} vectors")
+        return projection
+
+
+def delete_projection(name, directory):
+    """Removes the projection of a logical collection, so that the next vectors indexed into it fit a new one."""
+    path = projection_path(name, directory)
+    with _fit_lock:
+        _cache.pop(path, None)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+    logger.info(f"Removed the projection of {name}")
+    return True
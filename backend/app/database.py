@@ -1,12 +1,75 @@
+import json
+import os
 import sqlite3
+import threading
+import time
+import zlib
+
+_local = threading.local()
+
+# Chroma where operators supported by the lexical search filters
+WHERE_OPERATORS = {"$eq": "=", "$ne": "!=", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+
+
+def get_thread_db():
+    """Returns the connection of the current thread: a SQLite connection can only be used by the thread which opened it."""
+    if getattr(_local, "db", None) is None:
+        _local.db = SQLiteDB()
+    return _local.db
+
+
+def where_to_sql(where, column="metadata"):
+    """Translates a Chroma where filter into a SQL condition on a JSON metadata column, and its parameters."""
+    if "$and" in where or "$or" in where:
+        operator = "$and" if "$and" in where else "$or"
+        parts = [where_to_sql(condition, column) for condition in where[operator]]
+        sql = f" {operator[1:].upper()} ".join(f"({part_sql})" for part_sql, _ in parts)
+        return sql, [param for _, part_params in parts for param in part_params]
+    key, condition = next(iter(where.items()))
+    if not isinstance(condition, dict):
+        condition = {"$eq": condition}
+    operator, value = next(iter(condition.items()))
+    field = f"json_extract({column}, ?)"
+    params = [f'$."{key}"']
+    if operator in ("$in", "$nin"):
+        placeholders = ", ".join("?" for _ in value)
+        return f"{field} {'NOT IN' if operator == '$nin' else 'IN'} ({placeholders})", params + list(value)
+    return f"{field} {WHERE_OPERATORS[operator]} ?", params + [value]
 
 
 class SQLiteDB:
     def __init__(self):
-        self.conn = sqlite3.connect('FileWizardAi.db')
+        # Several workers may share the database: WAL lets readers run during a write, and writers wait for each other
+        self.conn = sqlite3.connect('FileWizardAi.db', timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
         self.cursor = self.conn.cursor()
         create_table_query = "CREATE TABLE IF NOT EXISTS files_summary (file_path TEXT PRIMARY KEY,file_hash TEXT NOT NULL,summary TEXT)"
         self.cursor.execute(create_table_query)
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS job_reports (id TEXT PRIMARY KEY, kind TEXT NOT NULL, "
+                            "started_at REAL NOT NULL, report TEXT NOT NULL)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS job_reports_kind ON job_reports (kind, started_at)")
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS extracted_text (file_hash TEXT NOT NULL, reader_version TEXT NOT NULL, "
+                            "kind TEXT NOT NULL, content BLOB NOT NULL, created_at REAL NOT NULL, "
+                            "PRIMARY KEY (file_hash, reader_version, kind))")
+        # Lexical index of the chunks stored in Chroma, searched with BM25 through an external content FTS5 table
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS lexical_chunks (id INTEGER PRIMARY KEY, collection TEXT NOT NULL, "
+                            "shard TEXT NOT NULL, chunk_id TEXT NOT NULL, file_path TEXT NOT NULL, file_name TEXT, "
+                            "metadata TEXT NOT NULL, document TEXT NOT NULL, UNIQUE (shard, chunk_id))")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS lexical_chunks_file ON lexical_chunks (collection, file_path)")
+        self.cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS lexical_chunks_fts USING fts5(document, file_name, "
+                            "content='lexical_chunks', content_rowid='id', tokenize='unicode61 remove_diacritics 2')")
+        self.cursor.execute("CREATE TRIGGER IF NOT EXISTS lexical_chunks_insert AFTER INSERT ON lexical_chunks BEGIN "
+                            "INSERT INTO lexical_chunks_fts (rowid, document, file_name) "
+                            "VALUES (new.id, new.document, new.file_name); END")
+        self.cursor.execute("CREATE TRIGGER IF NOT EXISTS lexical_chunks_delete AFTER DELETE ON lexical_chunks BEGIN "
+                            "INSERT INTO lexical_chunks_fts (lexical_chunks_fts, rowid, document, file_name) "
+                            "VALUES ('delete', old.id, old.document, old.file_name); END")
+        self.cursor.execute("CREATE TRIGGER IF NOT EXISTS lexical_chunks_update AFTER UPDATE ON lexical_chunks BEGIN "
+                            "INSERT INTO lexical_chunks_fts (lexical_chunks_fts, rowid, document, file_name) "
+                            "VALUES ('delete', old.id, old.document, old.file_name); "
+                            "INSERT INTO lexical_chunks_fts (rowid, document, file_name) "
+                            "VALUES (new.id, new.document, new.file_name); END")
         self.conn.commit()
 
     def select(self, table_name, where_clause=None):
@@ -49,15 +112,121 @@ class SQLiteDB:
         files_path = [row[0] for row in results]
         return files_path
 
-    def update_file(self, old_file_path, new_file_path, new_hash):
-        self.cursor.execute("UPDATE files_summary SET file_path = ?, file_hash = ? WHERE file_path = ?",
-                            (new_file_path, new_hash, old_file_path))
-        self.conn.commit()
+    def move_files(self, renames):
+        # Moving a file doesn't change its content, so the cached hash and summary are carried
+        # over to the new path. Everything is applied in a single transaction.
+        with self.conn:
+            rows = []
+            for old_file_path, new_file_path in renames.items():
+                self.cursor.execute("SELECT file_hash, summary FROM files_summary WHERE file_path = ?",
+                                    (old_file_path,))
+                row = self.cursor.fetchone()
+                if row:
+                    rows.append((new_file_path, row[0], row[1]))
+            # Delete first then insert, so that swapped or chained paths never hit the primary key
+            self.cursor.executemany("DELETE FROM files_summary WHERE file_path = ?",
+                                    [(file_path,) for file_path in renames])
+            self.cursor.executemany("INSERT OR REPLACE INTO files_summary (file_path, file_hash, summary) "
+                                    "VALUES (?, ?, ?)", rows)
+
+    def get_files_under(self, root_path):
+        # Range scan on the primary key, so only the rows under this root are read
+        prefix = os.path.join(root_path, "")
+        upper_bound = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        self.cursor.execute("SELECT file_path FROM files_summary WHERE file_path >= ? AND file_path < ?",
+                            (prefix, upper_bound))
+        return [row[0] for row in self.cursor.fetchall()]
 
     def delete_records(self, file_paths):
-        placeholders = ",".join("?" * len(file_paths))
-        self.cursor.execute(f"DELETE FROM files_summary WHERE file_path IN ({placeholders})", file_paths)
+        with self.conn:
+            self.cursor.executemany("DELETE FROM files_summary WHERE file_path = ?",
+                                    [(file_path,) for file_path in file_paths])
+
+    def insert_job_report(self, report):
+        self.cursor.execute("INSERT OR REPLACE INTO job_reports (id, kind, started_at, report) VALUES (?, ?, ?, ?)",
+                            (report["id"], report["kind"], report["started_at"], json.dumps(report)))
         self.conn.commit()
 
+    def get_job_reports(self, kind=None, limit=50):
+        if kind:
+            self.cursor.execute("SELECT report FROM job_reports WHERE kind = ? ORDER BY started_at DESC LIMIT ?",
+                                (kind, limit))
+        else:
+            self.cursor.execute("SELECT report FROM job_reports ORDER BY started_at DESC LIMIT ?", (limit,))
+        return [json.loads(row[0]) for row in self.cursor.fetchall()]
+
+    def get_job_report(self, job_id):
+        self.cursor.execute("SELECT report FROM job_reports WHERE id = ?", (job_id,))
+        result = self.cursor.fetchone()
+        return json.loads(result[0]) if result else None
+
+    def get_extracted_text(self, file_hash, reader_version, kind):
+        self.cursor.execute("SELECT content FROM extracted_text WHERE file_hash = ? AND reader_version = ? AND kind = ?",
+                            (file_hash, reader_version, kind))
+        result = self.cursor.fetchone()
+        return zlib.decompress(result[0]).decode() if result else None
+
+    def insert_extracted_text(self, file_hash, reader_version, kind, content):
+        self.cursor.execute("INSERT OR REPLACE INTO extracted_text (file_hash, reader_version, kind, content, created_at) "
+                            "VALUES (?, ?, ?, ?, ?)",
+                            (file_hash, reader_version, kind, zlib.compress(content.encode()), time.time()))
+        self.conn.commit()
+
+    def delete_extracted_text(self, keep_reader_version):
+        # Text extracted by older readers is never read again
+        with self.conn:
+            self.cursor.execute("DELETE FROM extracted_text WHERE reader_version != ?", (keep_reader_version,))
+            return self.cursor.rowcount
+
+    def upsert_lexical_chunks(self, collection, shard, ids, documents, metadatas):
+        rows = [(collection, shard, chunk_id, metadata.get("file_path", "Unknown"),
+                 metadata.get("file_name") or metadata.get("filename") or os.path.basename(metadata.get("file_path", "")),
+                 json.dumps(metadata), document)
+                for chunk_id, document, metadata in zip(ids, documents, metadatas)]
+        with self.conn:
+            self.cursor.executemany("INSERT INTO lexical_chunks (collection, shard, chunk_id, file_path, file_name, "
+                                    "metadata, document) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                                    "ON CONFLICT (shard, chunk_id) DO UPDATE SET collection = excluded.collection, "
+                                    "file_path = excluded.file_path, file_name = excluded.file_name, "
+                                    "metadata = excluded.metadata, document = excluded.document", rows)
+
+    def update_lexical_chunks(self, shard, ids, metadatas, target_shard=None):
+        # Only the location of the chunks changes, the document and its terms stay the same
+        rows = [(target_shard or shard, metadata["file_path"],
+                 metadata.get("file_name") or metadata.get("filename") or os.path.basename(metadata["file_path"]),
+                 json.dumps(metadata), shard, chunk_id)
+                for chunk_id, metadata in zip(ids, metadatas)]
+        with self.conn:
+            self.cursor.executemany("UPDATE lexical_chunks SET shard = ?, file_path = ?, file_name = ?, metadata = ? "
+                                    "WHERE shard = ? AND chunk_id = ?", rows)
+
+    def delete_lexical_chunks(self, shard, ids=None):
+        with self.conn:
+            if ids is None:
+                self.cursor.execute("DELETE FROM lexical_chunks WHERE shard = ?", (shard,))
+            else:
+                self.cursor.executemany("DELETE FROM lexical_chunks WHERE shard = ? AND chunk_id = ?",
+                                        [(shard, chunk_id) for chunk_id in ids])
+
+    def delete_lexical_files(self, collections, file_paths):
+        with self.conn:
+            self.cursor.executemany("DELETE FROM lexical_chunks WHERE collection = ? AND file_path = ?",
+                                    [(collection, file_path) for collection in collections for file_path in file_paths])
+
+    def search_lexical_chunks(self, shards, match_query, limit, where=None):
+        """Returns the (chunk_id, document, metadata, bm25) rows of the best matches in the given shards, best first."""
+        # Matches in the file name weigh twice as much as matches in the text
+        sql = ("SELECT c.chunk_id, c.document, c.metadata, bm25(lexical_chunks_fts, 1.0, 2.0) AS rank "
+               "FROM lexical_chunks_fts JOIN lexical_chunks c ON c.id = lexical_chunks_fts.rowid "
+               f"WHERE lexical_chunks_fts MATCH ? AND c.shard IN ({', '.join('?' for _ in shards)})")
+        params = [match_query, *shards]
+        if where:
+            where_sql, where_params = where_to_sql(where, "c.metadata")
+            sql += f" AND ({where_sql})"
+            params += where_params
+        self.cursor.execute(sql + " ORDER BY rank LIMIT ?", params + [limit])
+        return [(chunk_id, document, json.loads(metadata), rank) for chunk_id, document, metadata, rank
+                in self.cursor.fetchall()]
+
     def close(self):
         self.conn.close()
@@ -0,0 +1,71 @@
+import logging
+import multiprocessing
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+MODEL_NAME = 'all-MiniLM-L6-v2'
+
+# Model of the current worker process, and pool of the parent process
+_worker_model = None
+_pool = None
+
+
+def available_cpus():
+    """Number of CPUs this process is allowed to run on (cgroup/affinity aware on Linux)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _init_worker(model_name, threads):
+    global _worker_model
+    # Cap the threads of every native library before they are imported, so that
+    # N workers don't each start one thread per core.
+    for variable in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[variable] = str(threads)
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    import torch
+    from sentence_transformers import SentenceTransformer
+    torch.set_num_threads(threads)
+    _worker_model = SentenceTransformer(model_name, device="cpu")
+
+
+def encode(texts):
+    """Runs in a worker process: encodes a batch of texts in one forward pass. Returns the time it took as well."""
+    start = time.perf_counter()
+    embeddings = _worker_model.encode(texts, batch_size=len(texts), convert_to_tensor=False).tolist()
+    return embeddings, time.perf_counter() - start
+
+
+def get_pool(workers: int, threads: int = 0):
+    """
+    Returns the pool of embedding worker processes, created on first use, or None when
+    multi-process embedding is disabled (workers <= 1).
+    """
+    global _pool
+    if workers <= 1:
+        return None
+    if _pool is None:
+        cpus = available_cpus()
+        workers = min(workers, cpus)
+        if not threads:
+            threads = max(1, cpus // workers)
+            # Respect a thread limit configured on the host
+            if os.environ.get("OMP_NUM_THREADS", "").isdigit():
+                threads = max(1, min(threads, int(os.environ["OMP_NUM_THREADS"])))
+        logger.info(f"Starting {workers} embedding worker(s) with {threads} thread(s) each.")
+        # Spawn rather than fork: forking a process which already initialized torch can deadlock
+        context = multiprocessing.get_context("spawn")
+        _pool = context.Pool(workers, initializer=_init_worker, initargs=(MODEL_NAME, threads))
+    return _pool
+
+
+def close_pool():
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+        _pool = None
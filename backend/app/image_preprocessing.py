@@ -0,0 +1,107 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import io
+import logging
+import mimetypes
+import multiprocessing
+import os
+
+logger = logging.getLogger(__name__)
+
+# Formats every vision API accepts as they are
+SUPPORTED_FORMATS = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp", "GIF": "image/gif"}
+
+_executor = None
+
+
+def file_sha256(file_path):
+    hash_func = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            hash_func.update(chunk)
+    return hash_func.hexdigest()
+
+
+def prepare_image(image_path, image_hash, max_side, quality, cache_dir):
+    """
+    Runs in a worker process: decodes the image, downscales it so that its longest side is at most
+    max_side, and re-encodes it as JPEG (PNG when it has transparency). Images which are already small
+    enough and in a supported format are kept as they are. The result is cached under cache_dir by
+    content hash and settings. Returns the path of the prepared image and its MIME type.
+    """
+    from PIL import Image, ImageOps
+
+    image_hash = image_hash or file_sha256(image_path)
+    key = f"{image_hash}-{max_side}-{quality}"
+    for extension, mime_type in ((".jpg", "image/jpeg"), (".png", "image/png"), (".orig", None)):
+        cached_path = os.path.join(cache_dir, key + extension)
+        if os.path.exists(cached_path):
+            if mime_type is None:
+                with open(cached_path) as f:
+                    mime_type = f.read().strip()
+                cached_path = image_path
+            return cached_path, mime_type
+
+    os.makedirs(cache_dir, exist_ok=True)
+    try:
+        with Image.open(image_path) as image:
+            if image.format in SUPPORTED_FORMATS and max(image.size) <= max_side:
+                mime_type = SUPPORTED_FORMATS[image.format]
+                # Only the MIME type is cached, the original file is sent as it is
+                with open(os.path.join(cache_dir, key + ".orig"), "w") as f:
+                    f.write(mime_type)
+                return image_path, mime_type
+            # Let the JPEG decoder skip the resolution we don't need, much faster on large photos
+            image.draft("RGB", (max_side, max_side))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((max_side, max_side), Image.LANCZOS)
+            has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+            output = io.BytesIO()
+            if has_alpha:
+                image.save(output, format="PNG", optimize=True)
+                extension, mime_type = ".png", "image/png"
+            else:
+                image.convert("RGB").save(output, format="JPEG", quality=quality, optimize=True)
+                extension, mime_type = ".jpg", "image/jpeg"
+    except Exception as e:
+        # Formats Pillow can't decode are sent as they are
+        logger.warning(f"Could not preprocess image {image_path}: {e}")
+        return image_path, mimetypes.guess_type(image_path)[0] or "application/octet-stream"
+
+    cached_path = os.path.join(cache_dir, key + extension)
+    temp_path = f"{cached_path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(output.getvalue())
+    os.replace(temp_path, cached_path)
+    return cached_path, mime_type
+
+
+def get_executor(workers: int):
+    """Returns the pool of image preprocessing processes, created on first use, or None when workers is 0."""
+    global _executor
+    if workers <= 0:
+        return None
+    if _executor is None:
+        # Spawn rather than fork: the parent process may already have initialized torch
+        _executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _executor
+
+
+def close_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown()
+        _executor = None
+
+
+async def load_image(image_path, image_hash=None, max_side=1024, quality=85, cache_dir="image_cache", workers=2):
+    """Prepares an image for a vision model in the worker pool. Returns its bytes and its MIME type."""
+    loop = asyncio.get_running_loop()
+    prepared_path, mime_type = await loop.run_in_executor(
+        get_executor(workers), prepare_image, image_path, image_hash, max_side, quality, cache_dir
+    )
+    with open(prepared_path, "rb") as f:
+        return f.read(), mime_type
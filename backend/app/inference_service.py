@@ -0,0 +1,245 @@
+"""
+Local inference service: one process owns the embedding model and the CrossEncoder and serves every
+HTTP worker over a Unix socket, so that running uvicorn with several workers doesn't load the models
+once per worker. Requests arriving while the models are busy are merged into the next batch.
+
+Run from the backend folder, then start the app with INFERENCE_SERVICE_SOCKET set to the same path:
+
+    python -m app.inference_service --socket /tmp/filewizard-inference.sock
+    uvicorn app.server:app --workers 4
+
+Messages are framed as two big-endian 32 bit lengths, a JSON header and a binary payload (raw float32 results).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+
+import numpy as np
+
+from .embedding_pool import MODEL_NAME
+
+logger = logging.getLogger(__name__)
+
+CROSS_ENCODER_NAME = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+FRAME_HEADER = struct.Struct("!II")
+
+
+def pack_message(header, payload=b""):
+    header = json.dumps(header).encode()
+    return FRAME_HEADER.pack(len(header), len(payload)) + header + payload
+
+
+def pack_array(array):
+    array = np.ascontiguousarray(array, dtype=np.float32)
+    return pack_message({"shape": list(array.shape)}, array.tobytes())
+
+
+def unpack_array(header, payload):
+    if "error" in header:
+        raise RuntimeError(f"Inference service error: {header['error']}")
+    return np.frombuffer(payload, dtype=np.float32).reshape(header["shape"])
+
+
+class MicroBatcher:
+    """
+    Merges the items of concurrent requests into batches of up to max_batch_size items. A batch is run
+    as soon as it is full or max_wait seconds after its first request; requests arriving while a batch
+    runs wait for the next one, so batches grow with the load.
+    """
+
+    def __init__(self, run_batch, max_batch_size, max_wait):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+
+    async def submit(self, items):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((items, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            size = len(batch[0][0])
+            deadline = loop.time() + self.max_wait
+            while size < self.max_batch_size:
+                try:
+                    entry = await asyncio.wait_for(self.queue.get(), max(0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+                batch.append(entry)
+                size += len(entry[0])
+
+            items = [item for request_items, _ in batch for item in request_items]
+            try:
+                results = await asyncio.to_thread(self.run_batch, items)
+            except Exception as e:
+                logger.error(f"Inference batch of {len(items)} item(s) failed: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            logger.debug(f"Ran a batch of {len(items)} item(s) from {len(batch)} request(s)")
+            start = 0
+            for request_items, future in batch:
+                if not future.done():
+                    future.set_result(results[start:start + len(request_items)])
+                start += len(request_items)
+
+
+async def serve(socket_path, max_batch_size=64, max_wait=0.005):
+    from sentence_transformers import SentenceTransformer, CrossEncoder
+
+    model = SentenceTransformer(MODEL_NAME)
+    cross_encoder = CrossEncoder(CROSS_ENCODER_NAME)
+    batchers = {
+        "encode": MicroBatcher(
+            lambda texts: model.encode(texts, batch_size=max_batch_size, convert_to_tensor=False),
+            max_batch_size, max_wait,
+        ),
+        "rerank": MicroBatcher(
+            lambda pairs: cross_encoder.predict(pairs, batch_size=max_batch_size),
+            max_batch_size, max_wait,
+        ),
+    }
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                try:
+                    header_size, payload_size = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+                except asyncio.IncompleteReadError:
+                    return
+                request = json.loads(await reader.readexactly(header_size))
+                await reader.readexactly(payload_size)
+                try:
+                    batcher = batchers[request["op"]]
+                    items = request["texts"] if request["op"] == "encode" else request["pairs"]
+                    response = pack_array(await batcher.submit(items)) if items else pack_array(np.zeros((0,)))
+                except Exception as e:
+                    response = pack_message({"error": str(e)})
+                writer.write(response)
+                await writer.drain()
+        finally:
+            writer.close()
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = await asyncio.start_unix_server(handle, path=socket_path)
+    # Only the user running the service may connect
+    os.chmod(socket_path, 0o600)
+    tasks = [asyncio.create_task(batcher.run()) for batcher in batchers.values()]
+    logger.info(f"Inference service listening on {socket_path}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+class InferenceClient:
+    """Blocking client of the inference service, with one connection per thread."""
+
+    def __init__(self, socket_path, timeout=120.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connection(self):
+        if getattr(self.local, "socket", None) is None:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.settimeout(self.timeout)
+            connection.connect(self.socket_path)
+            self.local.socket = connection
+        return self.local.socket
+
+    def receive_exactly(self, connection, size):
+        data = bytearray()
+        while len(data) < size:
+            block = connection.recv(size - len(data))
+            if not block:
+                raise ConnectionError("Inference service closed the connection")
+            data.extend(block)
+        return bytes(data)
+
+    def request(self, header):
+        message = pack_message(header)
+        # A connection broken by a restart of the service is opened again once
+        for attempt in range(2):
+            connection = self.connection()
+            try:
+                connection.sendall(message)
+                header_size, payload_size = FRAME_HEADER.unpack(self.receive_exactly(connection, FRAME_HEADER.size))
+                response = json.loads(self.receive_exactly(connection, header_size))
+                return unpack_array(response, self.receive_exactly(connection, payload_size))
+            except (ConnectionError, OSError):
+                connection.close()
+                self.local.socket = None
+                if attempt:
+                    raise
+
+
+class RemoteSentenceTransformer:
+    """Stands for SentenceTransformer in rag_utils, the embeddings are computed by the inference service."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def encode(self, sentences, batch_size=None, convert_to_tensor=False, normalize_embeddings=False, **kwargs):
+        """
+        Same results as SentenceTransformer.encode. batch_size is ignored since the service batches the requests
+        of all the workers together, and the arguments it can't apply are rejected rather than ignored.
+        """
+        if convert_to_tensor or kwargs:
+            unsupported = sorted(kwargs) + (["convert_to_tensor"] if convert_to_tensor else [])
+            raise TypeError(f"Unsupported arguments for the inference service: {', '.join(unsupported)}")
+        # Like SentenceTransformer.encode, a single sentence gives a single vector
+        single = isinstance(sentences, str)
+        embeddings = self.client.request({"op": "encode", "texts": [sentences] if single else list(sentences)})
+        if normalize_embeddings:
+            norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+            embeddings = embeddings / np.maximum(norms, 1e-12)
+        return embeddings[0] if single else embeddings
+
+
+class RemoteCrossEncoder:
+    """Stands for CrossEncoder in rag_utils, the scores are computed by the inference service."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def predict(self, sentence_pairs, batch_size=None, **kwargs):
+        """Same scores as CrossEncoder.predict, batch_size is ignored like in RemoteSentenceTransformer.encode."""
+        if kwargs:
+            raise TypeError(f"Unsupported arguments for the inference service: {', '.join(sorted(kwargs))}")
+        # Like CrossEncoder.predict, a single pair gives a single score
+        single = isinstance(sentence_pairs[0], str) if len(sentence_pairs) else False
+        pairs = [sentence_pairs] if single else sentence_pairs
+        scores = self.client.request({"op": "rerank", "pairs": [list(pair) for pair in pairs]})
+        return scores[0] if single else scores
+
+
+def main():
+    from .settings import Settings
+
+    logging.basicConfig(level=logging.INFO)
+    settings = Settings()
+    parser = argparse.ArgumentParser(description="Serve the embedding and re-ranking models to all the app workers.")
+    parser.add_argument("--socket", default=settings.INFERENCE_SERVICE_SOCKET or "/tmp/filewizard-inference.sock")
+    parser.add_argument("--max-batch-size", type=int, default=settings.INFERENCE_MAX_BATCH_SIZE)
+    parser.add_argument("--max-wait-ms", type=float, default=settings.INFERENCE_BATCH_WAIT_MS,
+                        help="How long a request may wait for others to fill its batch")
+    args = parser.parse_args()
+    asyncio.run(serve(args.socket, args.max_batch_size, args.max_wait_ms / 1000))
+
+
+if __name__ == "__main__":
+    main()
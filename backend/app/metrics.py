@@ -0,0 +1,85 @@
+import contextvars
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+
+# Hot loops observe pre-bound children, so that no label lookup happens per call
+STAGE_SECONDS = Histogram(
+    "filewizard_stage_seconds",
+    "Time spent in each pipeline stage",
+    ["stage"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+FILE_READ_SECONDS = STAGE_SECONDS.labels(stage="file_read")
+HASH_SECONDS = STAGE_SECONDS.labels(stage="hash")
+CHUNKING_SECONDS = STAGE_SECONDS.labels(stage="chunking")
+EMBED_BATCH_SECONDS = STAGE_SECONDS.labels(stage="embed_batch")
+QUERY_EMBED_SECONDS = STAGE_SECONDS.labels(stage="query_embed")
+CHROMA_UPSERT_SECONDS = STAGE_SECONDS.labels(stage="chroma_upsert")
+CHROMA_QUERY_SECONDS = STAGE_SECONDS.labels(stage="chroma_query")
+RERANK_SECONDS = STAGE_SECONDS.labels(stage="rerank")
+IMAGE_PREPROCESS_SECONDS = STAGE_SECONDS.labels(stage="image_preprocess")
+
+SUMMARY_CACHE = Counter("filewizard_summary_cache_total", "Lookups of the files_summary cache", ["result"])
+SUMMARY_CACHE_HITS = SUMMARY_CACHE.labels(result="hit")
+SUMMARY_CACHE_MISSES = SUMMARY_CACHE.labels(result="miss")
+TEXT_CACHE = Counter("filewizard_text_cache_total", "Lookups of the extracted_text cache", ["result"])
+TEXT_CACHE_HITS = TEXT_CACHE.labels(result="hit")
+TEXT_CACHE_MISSES = TEXT_CACHE.labels(result="miss")
+
+EMBEDDED_CHUNKS = Counter("filewizard_embedded_chunks_total", "Chunks embedded and upserted into Chroma")
+
+LLM_REQUEST_SECONDS = Histogram(
+    "filewizard_llm_request_seconds",
+    "Latency of successful LLM requests",
+    ["operation"],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120),
+)
+# Keys are identified by their position in the settings, never by their value
+LLM_TOKENS = Counter("filewizard_llm_tokens_total", "Tokens sent to and received from the LLM", ["key", "direction"])
+LLM_RETRIES = Counter("filewizard_llm_retries_total", "Failed LLM requests which were retried", ["operation"])
+LLM_RATE_LIMITED = Counter("filewizard_llm_rate_limited_total", "LLM requests rejected with a 429", ["key"])
+# Operation of the LLM requests sent by the current task, for the labels of the HTTP hooks
+LLM_OPERATION = contextvars.ContextVar("llm_operation", default="unknown")
+
+
+def observe_llm_call(operation, key, seconds, usage=None):
+    LLM_REQUEST_SECONDS.labels(operation=operation).observe(seconds)
+    if usage is not None:
+        LLM_TOKENS.labels(key=key, direction="in").inc(usage.prompt_tokens or 0)
+        LLM_TOKENS.labels(key=key, direction="out").inc(usage.completion_tokens or 0)
+
+
+def llm_event_hooks(key):
+    """
+    httpx event hooks of the OpenAI client of a key. The SDK retries failed requests on its own, with backoff:
+    these retries, which it numbers in a header of each request, and every 429 are counted here.
+    """
+    async def on_request(request):
+        if request.headers.get("x-stainless-retry-count", "0") != "0":
+            LLM_RETRIES.labels(operation=LLM_OPERATION.get()).inc()
+
+    async def on_response(response):
+        if response.status_code == 429:
+            LLM_RATE_LIMITED.labels(key=key).inc()
+
+    return {"request": [on_request], "response": [on_response]}
+
+
+def observe_llm_error(operation, key, error, retried=True, counted_by_hooks=False):
+    """
+    Counts a failed LLM request, as a retry only when another attempt follows. The 429s of requests sent
+    through llm_event_hooks are already counted.
+    """
+    if retried:
+        LLM_RETRIES.labels(operation=operation).inc()
+    if counted_by_hooks:
+        return
+    # openai errors carry the status code, requests errors carry the response
+    status_code = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    if status_code == 429:
+        LLM_RATE_LIMITED.labels(key=key).inc()
+
+
+def render():
+    """Returns the metrics in the Prometheus text format, with their content type."""
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import math
+import os
+import re
+
+import numpy as np
+from sklearn.cluster import KMeans
+
+from . import rag_utils
+from .settings import Model
+
+logger = logging.getLogger(__name__)
+
+
+class Folder:
+    def __init__(self, indices, depth):
+        self.indices = indices
+        self.depth = depth
+        self.children = []
+        self.representatives = []
+        self.name = None
+
+
+def build_folders(embeddings, indices, depth, max_files_per_folder, max_depth, branching):
+    """Recursively splits the files with k-means until each folder is small enough (divisive clustering)."""
+    folder = Folder(indices, depth)
+    if len(indices) <= max_files_per_folder or depth >= max_depth:
+        return folder
+    k = min(branching, max(2, math.ceil(len(indices) / max_files_per_folder)))
+    labels = KMeans(n_clusters=k, n_init=10, random_state=0).fit_predict(embeddings[indices])
+    groups = [indices[labels == label] for label in range(k)]
+    groups = [group for group in groups if len(group)]
+    if len(groups) < 2:
+        return folder
+    folder.children = [build_folders(embeddings, group, depth + 1, max_files_per_folder, max_depth, branching)
+                       for group in groups]
+    return folder
+
+
+def select_representatives(folder, embeddings, count):
+    """The files closest to the centroid of each folder describe it to the LLM."""
+    vectors = embeddings[folder.indices]
+    centroid = vectors.mean(axis=0)
+    order = np.argsort(-(vectors @ centroid))
+    folder.representatives = folder.indices[order[:count]].tolist()
+    for child in folder.children:
+        select_representatives(child, embeddings, count)
+
+
+def iter_folders(folder):
+    yield folder
+    for child in folder.children:
+        yield from iter_folders(child)
+
+
+def normalize_name(name):
+    name = re.sub(r"[^\w\-]+", "_", name.strip().lower())
+    return re.sub(r"_+", "_", name).strip("_") or "misc"
+
+
+def unique_name(name, used):
+    candidate = name
+    suffix = 2
+    while candidate in used:
+        candidate = f"{name}_{suffix}"
+        suffix += 1
+    used.add(candidate)
+    return candidate
+
+
+def assign_paths(folder, summaries, parent_path, files):
+    used = set()
+    for child in folder.children:
+        child.name = unique_name(normalize_name(child.name or "misc"), used)
+        assign_paths(child, summaries, os.path.join(parent_path, child.name), files)
+    if not folder.children:
+        # Filenames are derived locally from the original names, no LLM call involved
+        for index in folder.indices.tolist():
+            src_path = summaries[index]["file_path"]
+            stem, ext = os.path.splitext(os.path.basename(src_path))
+            filename = unique_name(normalize_name(stem), used) + ext.lower()
+            files.append({"src_path": src_path, "dst_path": os.path.join(parent_path, filename)})
+
+
+async def create_file_tree(summaries: list, max_files_per_folder: int = 12, max_depth: int = 3,
+                           branching: int = 8, representatives: int = 3):
+    """
+    Organizes files by clustering their summary embeddings locally. The LLM is only asked to name
+    the folders from a few representative summaries, so the number of calls grows with the
+    number of folders instead of the number of files, and the whole tree is built in one pass.
+    """
+    if not summaries:
+        return []
+    texts = [summary["summary"] or summary["file_path"] for summary in summaries]
+    # The model may still have to be loaded, which would block the event loop
+    model = await asyncio.to_thread(rag_utils.get_model)
+    embeddings = await asyncio.to_thread(model.encode, texts, convert_to_tensor=False, normalize_embeddings=True)
+    embeddings = np.asarray(embeddings)
+    root = await asyncio.to_thread(build_folders, embeddings, np.arange(len(summaries)), 0,
+                                   max_files_per_folder, max_depth, branching)
+    select_representatives(root, embeddings, representatives)
+
+    folders = [folder for folder in iter_folders(root) if folder is not root]
+    logger.info(f"Clustered {len(summaries)} file(s) into {len(folders)} folder(s)")
+    if folders:
+        folder_ids = {id(folder): folder_id for folder_id, folder in enumerate(folders)}
+        parent_ids = {id(child): folder_ids.get(id(folder)) for folder in iter_folders(root)
+                      for child in folder.children}
+        model = Model()
+        names = await model.name_folders_api([
+            {
+                "id": folder_id,
+                "parent_id": parent_ids[id(folder)],
+                "summaries": [summaries[index]["summary"] for index in folder.representatives]
+            }
+            for folder_id, folder in enumerate(folders)
+        ])
+        for folder_id, folder in enumerate(folders):
+            folder.name = names.get(folder_id)
+
+    files = []
+    assign_paths(root, summaries, "", files)
+    return files
@@ -0,0 +1,169 @@
+"""
+Dry-run planning of /get_files and /index_files: lists the files the job would process, with the same
+filters, checks which ones hit the summary and extracted text caches, and estimates the LLM calls, tokens,
+chunks and wall-clock time of the job from the reports of the previous jobs (see profiling). Files are only
+hashed and, for cache hits, their cached text read: nothing is extracted, embedded or sent to the LLM.
+"""
+import json
+import math
+import os
+
+from llama_index.core import SimpleDirectoryReader
+
+from .database import get_thread_db
+from .run import SUMMARY_MAX_TOKENS
+from .settings import Settings
+from . import rag_utils
+from . import text_cache
+
+# Rough conversion used when only the size of the text is known
+CHARS_PER_TOKEN = 4
+# Extensions read as images by SimpleDirectoryReader, which are summarized by the vision model
+IMAGE_EXTS = {".jpg", ".jpeg", ".png"}
+# Typical prompt size of an image downscaled to IMAGE_MAX_SIDE by vision models
+IMAGE_TOKENS = 1000
+# Chunk size and overlap of iter_document_chunks, in tokens
+CHUNK_TOKENS = 384 - 40
+# Number of previous jobs the throughput is measured on
+HISTORY_SIZE = 20
+
+
+def stage_rate(reports, stage_name, count_name, fallback_count_name=None):
+    """
+    Seconds spent in a stage per unit counted by the jobs (file, chunk, LLM call...), None without history.
+    fallback_count_name is only used for the reports written before count_name was counted.
+    """
+    seconds = units = 0
+    for report in reports:
+        job_units = report["counts"].get(count_name)
+        if job_units is None and fallback_count_name and report.get("version", 1) < 2:
+            job_units = report["counts"].get(fallback_count_name)
+        stage = next((stage for stage in report["stages"] if stage["name"] == stage_name), None)
+        if not job_units or stage is None:
+            continue
+        seconds += stage["wall_seconds"]
+        units += job_units
+    return seconds / units if units else None
+
+
+def stage_average(reports, stage_name):
+    """Average seconds spent in a stage run once per job, None without history."""
+    durations = [stage["wall_seconds"] for report in reports for stage in report["stages"] if stage["name"] == stage_name]
+    return sum(durations) / len(durations) if durations else None
+
+
+def estimate_seconds(estimates):
+    """Totals the estimated seconds of each stage, or None when no stage could be estimated."""
+    known = [seconds for seconds in estimates.values() if seconds is not None]
+    return round(sum(known), 2) if known else None
+
+
+def scale(rate, units):
+    return None if rate is None else round(rate * units, 2)
+
+
+def inspect_file(file_path, kind, db):
+    """Returns the size, the hash and the cached text (or None) of a file, without extracting it."""
+    size = os.path.getsize(file_path)
+    file_hash = text_cache.get_file_hash(file_path)
+    content = db.get_extracted_text(file_hash, text_cache.READER_VERSION, kind)
+    return size, file_hash, content
+
+
+def cached_text_length(content):
+    return sum(len(page["text"]) for page in json.loads(content))
+
+
+def estimate_chunks(content):
+    """Estimates the chunks of cached pages, which are split paragraph by paragraph as in iter_document_chunks."""
+    return sum(math.ceil(len(paragraph) / CHARS_PER_TOKEN / CHUNK_TOKENS)
+               for page in json.loads(content) for paragraph in page["text"].split("\n\n") if paragraph.strip())
+
+
+def plan_get_files(root_path: str, recursive: bool, required_exts: list):
+    """Plans a /get_files job: summary cache hits, LLM calls, prompt tokens and duration."""
+    db = get_thread_db()
+    reader = SimpleDirectoryReader(input_dir=root_path, recursive=recursive, required_exts=required_exts,
+                                   errors='ignore')
+    kind = text_cache.summary_kind(SUMMARY_MAX_TOKENS)
+    plan = {"files": 0, "total_bytes": 0, "images": 0, "summary_cache_hits": 0, "text_cache_hits": 0,
+            "files_to_extract": 0, "files_to_summarize": 0, "estimated_input_tokens": 0}
+    for input_file in reader.input_files:
+        file_path = str(input_file)
+        try:
+            size, file_hash, content = inspect_file(file_path, kind, db)
+        except OSError:
+            continue
+        plan["files"] += 1
+        plan["total_bytes"] += size
+        is_image = os.path.splitext(file_path)[1].lower() in IMAGE_EXTS
+        plan["images"] += is_image
+        if content is None and not is_image:
+            # The summary text is derived from the cached pages when only those are cached
+            content = db.get_extracted_text(file_hash, text_cache.READER_VERSION, text_cache.PAGES)
+        if content is not None:
+            plan["text_cache_hits"] += 1
+        elif not is_image:
+            plan["files_to_extract"] += 1
+        if db.is_file_exist(file_path, file_hash):
+            plan["summary_cache_hits"] += 1
+            continue
+        plan["files_to_summarize"] += 1
+        if is_image:
+            plan["estimated_input_tokens"] += IMAGE_TOKENS
+        else:
+            # Without cached text, the file size is an upper bound of its text size
+            length = cached_text_length(content) if content is not None else size
+            plan["estimated_input_tokens"] += min(math.ceil(length / CHARS_PER_TOKEN), SUMMARY_MAX_TOKENS)
+
+    # The LLM organizer sends all the summaries in one more call
+    organize_calls = 1 if Settings().ORGANIZER_MODE != "cluster" and plan["files"] else 0
+    plan["llm_calls"] = plan["files_to_summarize"] + organize_calls
+
+    reports = db.get_job_reports("get_files", HISTORY_SIZE)
+    estimates = {
+        "load_documents": scale(stage_rate(reports, "load_documents", "extracted_files", "files"), plan["files_to_extract"]),
+        "prune": scale(stage_average(reports, "prune"), 1),
+        "summarize": scale(stage_rate(reports, "summarize", "llm_summaries"), plan["files_to_summarize"]),
+        "organize": scale(stage_average(reports, "organize"), 1),
+    }
+    return {**plan, "history_jobs": len(reports), "estimated_stage_seconds": estimates,
+            "estimated_seconds": estimate_seconds(estimates)}
+
+
+def plan_index_files(root_path: str, recursive: bool, required_exts: list, use_advanced_indexing: bool = False):
+    """Plans an /index_files job: extracted text cache hits, chunks to embed and duration."""
+    db = get_thread_db()
+    file_paths = rag_utils.list_files_to_index(root_path, recursive, required_exts)
+    reports = [report for report in db.get_job_reports("index_files", HISTORY_SIZE * 5)
+               if bool(report["params"].get("use_advanced_indexing")) == bool(use_advanced_indexing)][:HISTORY_SIZE]
+    history_files = sum(report["counts"].get("files", 0) for report in reports)
+    history_chunks = sum(report["counts"].get("chunks", 0) for report in reports)
+    chunks_per_file = history_chunks / history_files if history_files else None
+
+    plan = {"files": 0, "total_bytes": 0, "text_cache_hits": 0, "files_to_extract": 0, "estimated_chunks": 0}
+    for file_path in file_paths:
+        try:
+            size, _, content = inspect_file(file_path, text_cache.PAGES, db)
+        except OSError:
+            continue
+        plan["files"] += 1
+        plan["total_bytes"] += size
+        # The advanced pipeline partitions files with Unstructured, which doesn't use the text cache
+        if content is not None and not use_advanced_indexing:
+            plan["text_cache_hits"] += 1
+            plan["estimated_chunks"] += estimate_chunks(content)
+        else:
+            plan["files_to_extract"] += 1
+            plan["estimated_chunks"] += (chunks_per_file if chunks_per_file is not None
+                                         else max(1, size / CHARS_PER_TOKEN / CHUNK_TOKENS))
+    plan["estimated_chunks"] = round(plan["estimated_chunks"])
+
+    estimates = {
+        "list_files": scale(stage_average(reports, "list_files"), 1),
+        "parse": scale(stage_rate(reports, "parse", "extracted_files", "files"), plan["files_to_extract"]),
+    }
+    for stage_name in ("chunking", "embed", "upsert"):
+        estimates[stage_name] = scale(stage_rate(reports, stage_name, "chunks"), plan["estimated_chunks"])
+    return {**plan, "history_jobs": len(reports), "estimated_stage_seconds": estimates,
+            "estimated_seconds": estimate_seconds(estimates)}
@@ -0,0 +1,123 @@
+import collections
+import contextlib
+import contextvars
+import sys
+import threading
+import time
+import uuid
+
+_current_job = contextvars.ContextVar("current_job", default=None)
+# Version 2 reports list every counter of COUNTS, even when zero
+REPORT_VERSION = 2
+# Counters read by the planner, so that a job which never incremented one reports 0 rather than nothing
+COUNTS = ("files", "chunks", "extracted_files", "llm_summaries")
+
+
+class JobTimer:
+    """Wall-clock and CPU time spent in each stage of a job, plus counters (files, chunks, ...)."""
+
+    def __init__(self, kind, params=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params or {}
+        self.started_at = time.time()
+        self.stages = {}
+        self.counts = collections.Counter(dict.fromkeys(COUNTS, 0))
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time()
+        self.wall_seconds = None
+        self.cpu_seconds = None
+
+    def add(self, name, wall_seconds, cpu_seconds):
+        stage = self.stages.setdefault(name, {"name": name, "wall_seconds": 0.0, "cpu_seconds": 0.0, "calls": 0})
+        stage["wall_seconds"] += wall_seconds
+        stage["cpu_seconds"] += cpu_seconds
+        stage["calls"] += 1
+
+    def finish(self):
+        self.wall_seconds = time.perf_counter() - self._start_wall
+        self.cpu_seconds = time.process_time() - self._start_cpu
+
+    def report(self):
+        return {
+            "id": self.id,
+            "version": REPORT_VERSION,
+            "kind": self.kind,
+            "params": self.params,
+            "started_at": self.started_at,
+            "wall_seconds": round(self.wall_seconds or 0, 4),
+            # CPU time is process wide: it includes other requests running at the same time
+            "cpu_seconds": round(self.cpu_seconds or 0, 4),
+            "stages": [
+                {**stage, "wall_seconds": round(stage["wall_seconds"], 4), "cpu_seconds": round(stage["cpu_seconds"], 4)}
+                for stage in self.stages.values()
+            ],
+            "counts": dict(self.counts),
+        }
+
+
+@contextlib.contextmanager
+def job(kind, **params):
+    """Times a job (e.g. one /index_files request). Stages recorded by the code it runs are attached to it."""
+    timer = JobTimer(kind, params)
+    token = _current_job.set(timer)
+    try:
+        yield timer
+    finally:
+        timer.finish()
+        _current_job.reset(token)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Adds the time spent in the block to a stage of the current job, if any."""
+    timer = _current_job.get()
+    if timer is None:
+        yield
+        return
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - start_wall, time.process_time() - start_cpu)
+
+
+def count(name, value=1):
+    """Increments a counter of the current job, if any."""
+    timer = _current_job.get()
+    if timer is not None:
+        timer.counts[name] += value
+
+
+def frame_name(frame):
+    code = frame.f_code
+    module = frame.f_globals.get("__name__", "?")
+    return f"{module}:{code.co_name}"
+
+
+def sample_stacks(seconds: float, interval: float = 0.01):
+    """
+    Samples the Python stacks of all the threads of the process for the given duration and returns
+    them in the folded format ("thread;outer;...;inner count" per line), which flamegraph.pl,
+    speedscope and most flamegraph viewers read. Only the sampling thread runs extra code, so the
+    overhead on the profiled threads is limited to the GIL time taken by each sample.
+    """
+    stacks = collections.Counter()
+    sampler_id = threading.get_ident()
+    thread_names = {}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        if len(thread_names) != threading.active_count():
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == sampler_id:
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(frame_name(frame))
+                frame = frame.f_back
+            frames.append(thread_names.get(thread_id, str(thread_id)))
+            stacks[";".join(reversed(frames))] += 1
+        time.sleep(interval)
+    return "\n".join(f"{stack} {samples}" for stack, samples in stacks.most_common()) + "\n"
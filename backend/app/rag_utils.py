@@ -1,26 +1,78 @@
 import chromadb
+import chromadb.errors
 from llama_index.core import Document, SimpleDirectoryReader
 from llama_index.core.node_parser import SentenceSplitter
-from sentence_transformers import SentenceTransformer, CrossEncoder
-from llama_index.readers.file import UnstructuredReader
-from .settings import Model
-from .database import SQLiteDB
+from .settings import Model, Settings
+from .database import SQLiteDB, get_thread_db
+from . import compaction
+from . import embedding_pool
+from . import inference_service
+from . import metrics
+from . import profiling
+from . import text_cache
 import asyncio
+import collections
+import concurrent.futures
+import datetime
+import itertools
 import logging
 import hashlib
 import os
+import re
 import shutil
 import json
 import tempfile
-from unstructured.partition.auto import partition
+import threading
+import uuid
 
 logger = logging.getLogger(__name__)
 
-# Cache the model so it's loaded only once
-model = SentenceTransformer('all-MiniLM-L6-v2')
-cross_encoder = CrossEncoder('cross-encoder/ms-marco-MiniLM-L-6-v2')
+# The models are loaded on first use and cached, so that importing this module (e.g. for snapshots) never
+# loads them. With an inference service, the models are loaded by the service only and shared by all the
+# workers, and torch is never imported.
+_settings = Settings()
+_models = {}
+_models_lock = threading.Lock()
+
+def load_models():
+    """Returns the embedding model and the CrossEncoder, loading them on the first call."""
+    with _models_lock:
+        if not _models:
+            if _settings.INFERENCE_SERVICE_SOCKET:
+                inference_client = inference_service.InferenceClient(
+                    _settings.INFERENCE_SERVICE_SOCKET, _settings.INFERENCE_TIMEOUT_SECONDS
+                )
+                _models["model"] = inference_service.RemoteSentenceTransformer(inference_client)
+                _models["cross_encoder"] = inference_service.RemoteCrossEncoder(inference_client)
+            else:
+                from sentence_transformers import SentenceTransformer, CrossEncoder
+
+                _models["model"] = SentenceTransformer(embedding_pool.MODEL_NAME)
+                _models["cross_encoder"] = CrossEncoder(inference_service.CROSS_ENCODER_NAME)
+    return _models["model"], _models["cross_encoder"]
+
+def get_model():
+    return load_models()[0]
+
+def get_cross_encoder():
+    return load_models()[1]
+
 db = SQLiteDB()
 
+COLLECTION_NAMES = ["file_embeddings", "file_embeddings_unstructured"]
+# Shards are named <collection>__root_<hash of the root> or <collection>__shard_<n>
+SHARD_SEPARATOR = "__"
+SHARD_QUERY_WORKERS = 8
+# Batches queued per embedding worker: enough to keep the workers busy while the next batches are chunked
+EMBED_BATCHES_PER_WORKER = 2
+SEARCH_MODES = ("dense", "hybrid", "lexical")
+# Constant of reciprocal-rank fusion: higher values flatten the difference between the first ranks
+RRF_K = 60
+
+# Raised by get_collection for a missing collection, depending on the Chroma version
+COLLECTION_NOT_FOUND_ERRORS = tuple(getattr(chromadb.errors, name) for name in ("NotFoundError", "InvalidCollectionException")
+                                    if hasattr(chromadb.errors, name)) or (ValueError,)
+
 _poppler_installed = None
 _tesseract_installed = None
 
@@ -42,6 +94,21 @@ def get_chroma_client(path="chroma_db"):
     """Initializes and returns a ChromaDB client."""
     return chromadb.PersistentClient(path=path)
 
+def projections_dir(client):
+    """
+    Folder of the compact mode projections of a client's collections, inside its persist directory. Also takes
+    the API object a collection holds (collection._client), which has the same settings.
+    """
+    return os.path.join(client.get_settings().persist_directory, "projections")
+
+def collection_client(collection):
+    """Returns a client of the Chroma folder a collection belongs to, which may not be the default one (e.g. benchmarks)."""
+    return get_chroma_client(path=collection._client.get_settings().persist_directory)
+
+def get_collection_projection(collection):
+    """Returns the compact mode projection of the logical collection of a collection or shard, None for full vectors."""
+    return compaction.get_projection(base_collection_name(collection.name), projections_dir(collection._client))
+
 async def warm_up_unstructured():
     """
     Pre-downloads and caches the layout model for Unstructured to avoid
@@ -49,6 +116,8 @@ async def warm_up_unstructured():
     """
     logger.info("Starting warm-up for Unstructured layout model...")
     try:
+        from unstructured.partition.auto import partition
+
         # Create a temporary empty file to trigger the model download
         with tempfile.NamedTemporaryFile(suffix=".pdf", delete=True) as tmp:
             # This is a blocking I/O operation, so we run it in a thread.
@@ -59,9 +128,246 @@ async def warm_up_unstructured():
         # The app can still function, just the first request will be slow.
         logger.error(f"Unstructured warm-up failed: {e}")
 
-def create_collection(client, name="file_embeddings"):
-    """Creates a new collection or gets an existing one."""
-    return client.get_or_create_collection(name=name)
+def hnsw_metadata(base_name):
+    """HNSW parameters of a logical collection from the settings, as Chroma collection metadata."""
+    settings = Settings()
+    config = {
+        "space": settings.HNSW_SPACE,
+        "construction_ef": settings.HNSW_CONSTRUCTION_EF,
+        "search_ef": settings.HNSW_SEARCH_EF,
+        "M": settings.HNSW_M,
+    }
+    config.update(settings.HNSW_COLLECTION_CONFIG.get(base_name, {}))
+    return {f"hnsw:{key}": value for key, value in config.items()}
+
+def create_collection(client, name="file_embeddings", metadata: dict = None):
+    """
+    Gets an existing collection, or creates it with the HNSW parameters of its logical collection.
+    The parameters of an existing collection are left as they are: rebuild it to apply new ones.
+    """
+    try:
+        return client.get_collection(name)
+    except COLLECTION_NOT_FOUND_ERRORS:
+        return client.get_or_create_collection(name=name, metadata={**hnsw_metadata(base_collection_name(name)), **(metadata or {})})
+
+def base_collection_name(name):
+    """Name of the logical collection ("file_embeddings" or "file_embeddings_unstructured") a shard belongs to."""
+    return name.split(SHARD_SEPARATOR, 1)[0]
+
+def list_shards(client, base_name):
+    """Names of the collections holding chunks of a logical collection: the collection itself and its shards."""
+    # Depending on the Chroma version, list_collections returns collections or their names
+    names = [item if isinstance(item, str) else item.name for item in client.list_collections()]
+    return sorted(name for name in names if name == base_name or name.startswith(base_name + SHARD_SEPARATOR))
+
+def get_shard_roots(client, base_name):
+    """Maps the root folder of each per-root shard of a logical collection to the shard name."""
+    roots = {}
+    for name in list_shards(client, base_name):
+        metadata = client.get_collection(name).metadata or {}
+        if "root" in metadata:
+            roots[metadata["root"]] = name
+    return roots
+
+def assign_shards(client, base_name, file_paths: list, root_paths: list = None):
+    """
+    Groups files by the shard of a logical collection they belong to, according to COLLECTION_SHARDING:
+    "none" keeps everything in the collection itself, "hash" spreads files over COLLECTION_SHARDS shards
+    by path hash, and "root" gives each indexed root its own shard. In root mode a file goes to the
+    shard of the deepest known root containing it, otherwise to a new shard for the deepest of
+    root_paths containing it, or for its folder. Returns {shard name: (file paths, collection metadata)}.
+    """
+    settings = Settings()
+    groups = {}
+    if settings.COLLECTION_SHARDING == "hash":
+        for file_path in file_paths:
+            shard = int(hashlib.sha256(file_path.encode()).hexdigest()[:8], 16) % settings.COLLECTION_SHARDS
+            groups.setdefault(f"{base_name}{SHARD_SEPARATOR}shard_{shard}", ([], None))[0].append(file_path)
+    elif settings.COLLECTION_SHARDING == "root":
+        roots = set(get_shard_roots(client, base_name))
+        candidates = {ancestor_paths(root_path)[-1] for root_path in root_paths or []}
+        for file_path in file_paths:
+            directories = ancestor_paths(os.path.dirname(file_path))[::-1]
+            root = next((directory for directory in directories if directory in roots), None)
+            if root is None:
+                root = next((directory for directory in directories if directory in candidates), directories[0])
+                roots.add(root)
+            name = f"{base_name}{SHARD_SEPARATOR}root_{hashlib.sha256(root.encode()).hexdigest()[:12]}"
+            groups.setdefault(name, ([], {"root": root}))[0].append(file_path)
+    else:
+        groups[base_name] = (list(file_paths), None)
+    return groups
+
+def get_search_collections(client, base_name, path_prefix: str = None):
+    """
+    Returns the shards to search for a logical collection, skipping the per-root shards which
+    cannot contain files under path_prefix. The list is empty when no shard can contain such files.
+    """
+    names = list_shards(client, base_name)
+    if not names:
+        return [create_collection(client, name=base_name)]
+    shards = [client.get_collection(name) for name in names]
+    if path_prefix:
+        prefix = ancestor_paths(path_prefix)[-1]
+
+        def may_contain(shard):
+            root = (shard.metadata or {}).get("root")
+            return root is None or os.path.commonpath([root, prefix]) in (root, prefix)
+
+        shards = [shard for shard in shards if may_contain(shard)]
+    return shards
+
+def describe_shards():
+    """Lists the shards of every logical collection with their root (per-root sharding) and their number of chunks."""
+    chroma_client = get_chroma_client()
+    shards = []
+    for base_name in COLLECTION_NAMES:
+        for name in list_shards(chroma_client, base_name):
+            collection = chroma_client.get_collection(name)
+            shards.append({
+                "name": name,
+                "collection": base_name,
+                "root": (collection.metadata or {}).get("root"),
+                "count": collection.count()
+            })
+    return shards
+
+def drop_shard(name):
+    """Deletes one shard with all its chunks. Returns False when there is no such shard."""
+    chroma_client = get_chroma_client()
+    if name not in list_shards(chroma_client, base_collection_name(name)):
+        return False
+    chroma_client.delete_collection(name)
+    get_thread_db().delete_lexical_chunks(name)
+    logger.info(f"Dropped shard {name}")
+    base_name = base_collection_name(name)
+    if not list_shards(chroma_client, base_name):
+        # Nothing uses the projection anymore: the next files indexed fit one with the current settings
+        compaction.delete_projection(base_name, projections_dir(chroma_client))
+    return True
+
+def rebuild_shard(name, reembed: bool = False, batch_size: int = 256):
+    """
+    Rebuilds one shard. By default its stored embeddings are copied into a fresh collection, which
+    rebuilds the HNSW index with the current HNSW settings, without the space left by deleted chunks
+    and without running the model.
+    With reembed, the files of the shard are read and embedded again. Returns False when there is no such shard.
+    """
+    chroma_client = get_chroma_client()
+    base_name = base_collection_name(name)
+    if name not in list_shards(chroma_client, base_name):
+        return False
+    collection = chroma_client.get_collection(name)
+    metadata = collection.metadata
+
+    if reembed:
+        file_paths = set()
+        for start in range(0, collection.count(), batch_size):
+            records = collection.get(include=["metadatas"], limit=batch_size, offset=start)
+            file_paths.update(record["file_path"] for record in records["metadatas"])
+        chroma_client.delete_collection(name)
+        get_thread_db().delete_lexical_chunks(name)
+        root_paths = [metadata["root"]] if metadata and "root" in metadata else None
+        index_files([path for path in file_paths if os.path.isfile(path)],
+                    use_advanced_indexing=base_name == "file_embeddings_unstructured", root_paths=root_paths)
+    else:
+        # The copy is not named after the collection, so it isn't searched until it replaces the shard.
+        # It gets the current HNSW parameters, so a rebuild also applies new settings.
+        metadata = {key: value for key, value in (metadata or {}).items() if not key.startswith("hnsw:")}
+        rebuilt = chroma_client.create_collection(
+            name=f"rebuild_{uuid.uuid4().hex}", metadata={**metadata, **hnsw_metadata(base_name)}
+        )
+        for start in range(0, collection.count(), batch_size):
+            records = collection.get(include=["documents", "metadatas", "embeddings"], limit=batch_size, offset=start)
+            rebuilt.add(ids=records["ids"], embeddings=records["embeddings"], documents=records["documents"],
+                        metadatas=records["metadatas"])
+        chroma_client.delete_collection(name)
+        rebuilt.modify(name=name)
+    logger.info(f"Rebuilt shard {name}")
+    return True
+
+def rename_file_paths(renames: dict, batch_size: int = 256):
+    """
+    Points the chunks of moved files to their new location by rewriting their file_path and
+    filename metadata in place. Documents and embeddings are left untouched, so nothing is re-embedded.
+    Chunks whose new path belongs to another shard are moved there with their embeddings. They keep their
+    IDs, which were derived from the old path: indexing these files again replaces them (see index_files_from_path).
+    """
+    if not renames:
+        return
+    chroma_client = get_chroma_client()
+    old_paths = list(renames)
+    for base_name in COLLECTION_NAMES:
+        targets = {}
+        for shard_name, (file_paths, shard_metadata) in assign_shards(chroma_client, base_name, list(renames.values())).items():
+            for file_path in file_paths:
+                targets[file_path] = (shard_name, shard_metadata)
+
+        for shard_name in list_shards(chroma_client, base_name):
+            collection = chroma_client.get_collection(shard_name)
+            for start in range(0, len(old_paths), batch_size):
+                records = collection.get(
+                    where={"file_path": {"$in": old_paths[start:start + batch_size]}},
+                    include=["metadatas"]
+                )
+                if not records["ids"]:
+                    continue
+                in_place = {"ids": [], "metadatas": []}
+                moving = collections.defaultdict(lambda: {"ids": [], "metadatas": []})
+                for record_id, metadata in zip(records["ids"], records["metadatas"]):
+                    new_path = renames[metadata["file_path"]]
+                    metadata["file_path"] = new_path
+                    # Unstructured stores "filename", SimpleDirectoryReader stores "file_name"
+                    for key in ("filename", "file_name"):
+                        if key in metadata:
+                            metadata[key] = os.path.basename(new_path)
+                    # Remove the directories of the old path which are deeper than the new one
+                    for key in [key for key in metadata if key.startswith("dir_")]:
+                        metadata[key] = None
+                    metadata.update(path_metadata(new_path))
+                    target = targets[new_path][0]
+                    group = in_place if target == shard_name else moving[target]
+                    group["ids"].append(record_id)
+                    group["metadatas"].append(metadata)
+
+                if in_place["ids"]:
+                    collection.update(ids=in_place["ids"], metadatas=in_place["metadatas"])
+                    get_thread_db().update_lexical_chunks(
+                        shard_name, in_place["ids"],
+                        [{key: value for key, value in metadata.items() if value is not None}
+                         for metadata in in_place["metadatas"]]
+                    )
+                for target, group in moving.items():
+                    stored = collection.get(ids=group["ids"], include=["documents", "embeddings"])
+                    stored_by_id = {record_id: (document, embedding) for record_id, document, embedding
+                                    in zip(stored["ids"], stored["documents"], stored["embeddings"])}
+                    target_collection = create_collection(
+                        chroma_client, name=target, metadata=targets[group["metadatas"][0]["file_path"]][1]
+                    )
+                    # None only deletes keys on update, new records simply don't have them
+                    metadatas = [{key: value for key, value in metadata.items() if value is not None}
+                                 for metadata in group["metadatas"]]
+                    target_collection.upsert(
+                        ids=group["ids"],
+                        documents=[stored_by_id[record_id][0] for record_id in group["ids"]],
+                        embeddings=[stored_by_id[record_id][1] for record_id in group["ids"]],
+                        metadatas=metadatas
+                    )
+                    collection.delete(ids=group["ids"])
+                    get_thread_db().update_lexical_chunks(shard_name, group["ids"], metadatas, target_shard=target)
+            logger.info(f"Updated paths of moved files in collection {shard_name}")
+
+def delete_file_chunks(file_paths: list, collection_names: list = COLLECTION_NAMES, batch_size: int = 256):
+    """Removes the chunks of the given files from the collections and all their shards, in batches."""
+    if not file_paths:
+        return
+    chroma_client = get_chroma_client()
+    get_thread_db().delete_lexical_files(collection_names, file_paths)
+    for collection_name in collection_names:
+        for shard_name in list_shards(chroma_client, collection_name):
+            collection = chroma_client.get_collection(shard_name)
+            for start in range(0, len(file_paths), batch_size):
+                collection.delete(where={"file_path": {"$in": file_paths[start:start + batch_size]}})
 
 def generate_node_id(file_path, page_number, content, chunk_index):
     """Generates a deterministic ID for a node based on its content, source, and chunk order."""
@@ -92,20 +398,185 @@ def standardize_metadata(metadata):
 
     if "file_path" not in processed_metadata:
         processed_metadata["file_path"] = "Unknown"
+    else:
+        processed_metadata.update(path_metadata(processed_metadata["file_path"]))
+        try:
+            processed_metadata["file_mtime"] = os.path.getmtime(processed_metadata["file_path"])
+        except OSError:
+            pass
+
+    # Integer copy of the page number, for page range filters
+    if processed_metadata["page_number"].isdigit():
+        processed_metadata["page_num"] = int(processed_metadata["page_number"])
 
     return processed_metadata
 
-def index_documents(documents: list[Document], collection):
+def ancestor_paths(path):
+    """Returns the chain of directories from the filesystem root down to the given path, both included."""
+    path = os.path.normpath(os.path.abspath(path))
+    paths = [path]
+    while os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+        paths.append(path)
+    return paths[::-1]
+
+def path_metadata(file_path):
     """
-    Processes and indexes documents in batches with standardized metadata and deterministic IDs.
+    Metadata used to filter searches by location and type: the lowercase extension, and one
+    dir_<depth> field per ancestor directory, so that a path prefix becomes an exact match on one field.
     """
-    splitter = SentenceSplitter(chunk_size=384, chunk_overlap=40)
+    metadata = {"file_ext": os.path.splitext(file_path)[1].lower()}
+    for depth, directory in enumerate(ancestor_paths(os.path.dirname(file_path))):
+        metadata[f"dir_{depth}"] = directory
+    return metadata
+
+def parse_timestamp(value):
+    """Parses a Unix timestamp or an ISO 8601 date into a Unix timestamp."""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+def build_where_filter(path_prefix: str = None, exts: list = None, page_min: int = None, page_max: int = None,
+                       modified_after=None, modified_before=None):
+    """
+    Builds the Chroma where filter scoping a search, or None when nothing is filtered. Chunks indexed
+    before these fields existed don't have them and are excluded from filtered searches until re-indexed.
+    """
+    conditions = []
+    if path_prefix:
+        directories = ancestor_paths(path_prefix)
+        conditions.append({f"dir_{len(directories) - 1}": directories[-1]})
+    if exts:
+        exts = [ext.lower() if ext.startswith(".") else f".{ext.lower()}" for ext in exts]
+        conditions.append({"file_ext": {"$in": exts}})
+    if page_min is not None:
+        conditions.append({"page_num": {"$gte": int(page_min)}})
+    if page_max is not None:
+        conditions.append({"page_num": {"$lte": int(page_max)}})
+    if modified_after is not None:
+        conditions.append({"file_mtime": {"$gte": parse_timestamp(modified_after)}})
+    if modified_before is not None:
+        conditions.append({"file_mtime": {"$lte": parse_timestamp(modified_before)}})
+
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+def iter_batches(chunks, batch_size: int = 32):
+    """Groups (id, document, metadata) chunks into batches of parallel lists."""
+    chunks = iter(chunks)
+    while True:
+        # Chunks are generated lazily, so pulling a batch measures the chunking time
+        with metrics.CHUNKING_SECONDS.time(), profiling.stage("chunking"):
+            batch = list(itertools.islice(chunks, batch_size))
+        if not batch:
+            return
+        batch_ids, batch_documents, batch_metadatas = (list(column) for column in zip(*batch))
+        yield batch_ids, batch_documents, batch_metadatas
 
-    batch_size = 32
-    batch_embeddings = []
-    batch_documents = []
-    batch_metadatas = []
-    batch_ids = []
+def embed_batches(batches):
+    """
+    Adds embeddings to each batch. Batches are encoded in one forward pass each, either locally
+    or, when EMBEDDING_WORKERS is set, sharded across the worker processes of the embedding pool.
+    """
+    settings = Settings()
+    pool = embedding_pool.get_pool(settings.EMBEDDING_WORKERS, settings.EMBEDDING_WORKER_THREADS)
+    if pool is None:
+        for ids, documents, metadatas in batches:
+            with metrics.EMBED_BATCH_SECONDS.time(), profiling.stage("embed"):
+                embeddings = get_model().encode(documents, convert_to_tensor=False).tolist()
+            yield ids, documents, metadatas, embeddings
+        return
+
+    # Batches are submitted in order and at most EMBED_BATCHES_PER_WORKER per worker are in flight, so chunking
+    # runs in this thread just ahead of the workers instead of materializing every chunk of the job
+    max_in_flight = EMBED_BATCHES_PER_WORKER * settings.EMBEDDING_WORKERS
+    batches = iter(batches)
+    pending = collections.deque()
+    while True:
+        while len(pending) < max_in_flight:
+            batch = next(batches, None)
+            if batch is None:
+                break
+            pending.append((batch, pool.apply_async(embedding_pool.encode, (batch[1],))))
+        if not pending:
+            return
+        (ids, documents, metadatas), result = pending.popleft()
+        with profiling.stage("embed"):
+            embeddings, seconds = result.get()
+        metrics.EMBED_BATCH_SECONDS.observe(seconds)
+        yield ids, documents, metadatas, embeddings
+
+def is_collection_empty(chroma_client, base_name):
+    """True when neither the logical collection nor any of its shards holds a chunk."""
+    return all(chroma_client.get_collection(name).count() == 0 for name in list_shards(chroma_client, base_name))
+
+def compact_batches(batches, collection):
+    """
+    Applies the projection of compact mode to embedded batches. When COMPACT_VECTORS is set and the
+    logical collection is still empty, the first batches are held back until COMPACT_FIT_SAMPLE vectors
+    are available to fit the projection, which is then used for every vector of the collection and its shards.
+    """
+    base_name = base_collection_name(collection.name)
+    projection = get_collection_projection(collection)
+    settings = Settings()
+    if projection is None and settings.COMPACT_VECTORS != "none":
+        chroma_client = collection_client(collection)
+        if is_collection_empty(chroma_client, base_name):
+            batches = iter(batches)
+            buffered = []
+            sample_size = 0
+            for batch in batches:
+                buffered.append(batch)
+                sample_size += len(batch[0])
+                if sample_size >= settings.COMPACT_FIT_SAMPLE:
+                    break
+            # PCA needs enough vectors to find meaningful components, truncation needs none
+            min_sample_size = 2 * settings.COMPACT_DIMENSIONS if settings.COMPACT_VECTORS == "pca" else 1
+            if sample_size >= min_sample_size:
+                sample = [embedding for batch in buffered for embedding in batch[3]]
+                projection = compaction.fit_and_save(
+                    base_name, settings.COMPACT_VECTORS, settings.COMPACT_DIMENSIONS, sample,
+                    projections_dir(chroma_client)
+                )
+            else:
+                logger.warning(f"Only {sample_size} chunk(s) to fit the {settings.COMPACT_VECTORS} projection "
+                               f"of {base_name}, storing full vectors")
+            batches = itertools.chain(buffered, batches)
+        else:
+            logger.warning(f"{base_name} already holds full vectors, COMPACT_VECTORS only applies once "
+                           f"its shards are dropped and the files indexed again")
+
+    for ids, documents, metadatas, embeddings in batches:
+        if projection is not None:
+            embeddings = projection.apply(embeddings).tolist()
+        yield ids, documents, metadatas, embeddings
+
+def upsert_chunks(chunks, collection, batch_size: int = 32):
+    """
+    Embeds (id, document, metadata) chunks and upserts them batch by batch into the collection and the
+    lexical index. Returns the number of chunks.
+    """
+    count = 0
+    db = get_thread_db()
+    base_name = base_collection_name(collection.name)
+    batches = compact_batches(embed_batches(iter_batches(chunks, batch_size)), collection)
+    for ids, documents, metadatas, embeddings in batches:
+        with metrics.CHROMA_UPSERT_SECONDS.time(), profiling.stage("upsert"):
+            collection.upsert(embeddings=embeddings, documents=documents, metadatas=metadatas, ids=ids)
+            # The lexical index gets the same chunks, for hybrid and lexical searches
+            db.upsert_lexical_chunks(base_name, collection.name, ids, documents, metadatas)
+        metrics.EMBEDDED_CHUNKS.inc(len(ids))
+        profiling.count("chunks", len(ids))
+        count += len(ids)
+    return count
+
+def iter_document_chunks(documents: list[Document]):
+    """Splits documents paragraph by paragraph into chunks with standardized metadata and deterministic IDs."""
+    splitter = SentenceSplitter(chunk_size=384, chunk_overlap=40)
     chunk_index = 0
 
     for doc in documents:
@@ -124,43 +595,20 @@ def index_documents(documents: list[Document], collection):
 
                     node_id = generate_node_id(file_path, page_number, content, chunk_index)
                     chunk_index += 1
+                    yield node_id, content, node.metadata
 
-                    batch_embeddings.append(model.encode(content, convert_to_tensor=False).tolist())
-                    batch_documents.append(content)
-                    batch_metadatas.append(node.metadata)
-                    batch_ids.append(node_id)
-
-                    if len(batch_ids) >= batch_size:
-                        collection.upsert(
-                            embeddings=batch_embeddings,
-                            documents=batch_documents,
-                            metadatas=batch_metadatas,
-                            ids=batch_ids
-                        )
-                        # Reset batches
-                        batch_embeddings, batch_documents, batch_metadatas, batch_ids = [], [], [], []
-
-    # Add any remaining documents in the last batch
-    if batch_ids:
-        collection.upsert(
-            embeddings=batch_embeddings,
-            documents=batch_documents,
-            metadatas=batch_metadatas,
-            ids=batch_ids
-        )
+def index_documents(documents: list[Document], collection):
+    """
+    Processes and indexes documents in batches with standardized metadata and deterministic IDs.
+    """
+    upsert_chunks(iter_document_chunks(documents), collection)
 
-def index_documents_unstructured(elements, collection):
+def iter_unstructured_chunks(elements):
     """
-    Processes elements from Unstructured partition_auto, groups them into semantic chunks,
-    and indexes them into ChromaDB.
+    Groups elements from Unstructured partition_auto into semantic chunks with standardized
+    metadata and deterministic IDs.
     """
-    batch_size = 32
-    batch_embeddings = []
-    batch_documents = []
-    batch_metadatas = []
-    batch_ids = []
     chunk_index = 0
-
     current_chunk_text = []
     current_chunk_elements = []
     current_chunk_text_length = 0
@@ -168,11 +616,7 @@ def index_documents_unstructured(elements, collection):
     # This is character length, not token length.
     max_chunk_length = 1500
 
-    def process_chunk():
-        nonlocal chunk_index, batch_embeddings, batch_documents, batch_metadatas, batch_ids
-        if not current_chunk_elements:
-            return
-
+    def make_chunk():
         combined_text = "\n\n".join(current_chunk_text)
 
         first_element = current_chunk_elements[0]
@@ -182,16 +626,7 @@ def index_documents_unstructured(elements, collection):
         page_number = metadata.get("page_number", "Unknown")
 
         node_id = generate_node_id(file_path, page_number, combined_text, chunk_index)
-        chunk_index += 1
-
-        batch_documents.append(combined_text)
-        batch_metadatas.append(metadata)
-        batch_ids.append(node_id)
-        batch_embeddings.append(model.encode(combined_text, convert_to_tensor=False).tolist())
-
-        if len(batch_ids) >= batch_size:
-            collection.upsert(embeddings=batch_embeddings, documents=batch_documents, metadatas=batch_metadatas, ids=batch_ids)
-            batch_embeddings, batch_documents, batch_metadatas, batch_ids = [], [], [], []
+        return node_id, combined_text, metadata
 
     for element in elements:
         element_text_length = len(element.text)
@@ -202,7 +637,8 @@ def index_documents_unstructured(elements, collection):
         # Condition to split: new section starts or chunk gets too long
         if (is_new_section_start and current_chunk_elements) or \
            (current_chunk_text_length + element_text_length > max_chunk_length and current_chunk_elements):
-            process_chunk()
+            yield make_chunk()
+            chunk_index += 1
             # Reset for the next chunk
             current_chunk_text = []
             current_chunk_elements = []
@@ -213,127 +649,141 @@ def index_documents_unstructured(elements, collection):
         current_chunk_text_length += element_text_length
 
     # Process any remaining chunk after the loop
-    process_chunk()
-
-    # Upsert any remaining items in the last batch
-    if batch_ids:
-        collection.upsert(embeddings=batch_embeddings, documents=batch_documents, metadatas=batch_metadatas, ids=batch_ids)
-
-    logger.info(f"Successfully indexed {chunk_index} semantic chunks.")
+    if current_chunk_elements:
+        yield make_chunk()
 
+def index_documents_unstructured(elements, collection):
+    """
+    Processes elements from Unstructured partition_auto, groups them into semantic chunks,
+    and indexes them into ChromaDB.
+    """
+    chunk_count = upsert_chunks(iter_unstructured_chunks(elements), collection)
+    logger.info(f"Successfully indexed {chunk_count} semantic chunks.")
+
+
+def list_files_to_index(root_path: str, recursive: bool, required_exts: list):
+    """Lists the files under a path with one of the required extensions, skipping temporary Office files."""
+    # We must manually filter out temporary files for SimpleDirectoryReader
+    # by providing a list of files, as it doesn't support exclusion patterns directly.
+    files_to_process = []
+    if recursive:
+        for dirpath, _, filenames in os.walk(root_path):
+            for filename in filenames:
+                if not filename.startswith('~$'):
+                    files_to_process.append(os.path.join(dirpath, filename))
+    else:
+        files_to_process = [os.path.join(root_path, f) for f in os.listdir(root_path) if os.path.isfile(os.path.join(root_path, f)) and not f.startswith('~$')]
 
-async def index_files_from_path(root_path: str, recursive: bool, required_exts: list, use_advanced_indexing: bool = False):
-    """Loads documents from a path and indexes them into ChromaDB."""
-    collection_name = "file_embeddings_unstructured" if use_advanced_indexing else "file_embeddings"
-    logger.info(f"Using collection: {collection_name}")
-    chroma_client = get_chroma_client()
-    collection = create_collection(chroma_client, name=collection_name)
-
-    if use_advanced_indexing:
-        logger.info("Using advanced indexing with Unstructured partition_auto.")
-
-        files_to_process = []
-        if recursive:
-            for dirpath, _, filenames in os.walk(root_path):
-                for filename in filenames:
-                    if not filename.startswith('~$'):
-                        files_to_process.append(os.path.join(dirpath, filename))
-        else:
-            files_to_process = [os.path.join(root_path, f) for f in os.listdir(root_path) if os.path.isfile(os.path.join(root_path, f)) and not f.startswith('~$')]
+    # Filter by extension after collecting all files
+    return [f for f in files_to_process if any(f.endswith(ext) for ext in required_exts)]
 
-        filtered_files = [f for f in files_to_process if any(f.endswith(ext) for ext in required_exts)]
-        logger.info(f"Found {len(filtered_files)} file(s) to process with Unstructured.")
+def partition_files(file_paths: list):
+    """Partitions files with Unstructured, choosing the best strategy available for each file type."""
+    # Unstructured is slow to import, only the advanced indexing needs it
+    from unstructured.partition.auto import partition
 
-        all_elements = []
-        poppler_present = is_poppler_installed()
-        tesseract_present = is_tesseract_installed()
+    all_elements = []
+    poppler_present = is_poppler_installed()
+    tesseract_present = is_tesseract_installed()
 
-        if not poppler_present:
-            logger.warning("Poppler is not installed or not in PATH. PDF parsing will be degraded to 'fast' mode.")
-        if not tesseract_present:
-            logger.warning("Tesseract is not installed or not in PATH. Image parsing will be skipped.")
+    if not poppler_present:
+        logger.warning("Poppler is not installed or not in PATH. PDF parsing will be degraded to 'fast' mode.")
+    if not tesseract_present:
+        logger.warning("Tesseract is not installed or not in PATH. Image parsing will be skipped.")
 
-        for filename in filtered_files:
-            try:
-                # Skip image files if Tesseract is not installed
-                file_ext = os.path.splitext(filename)[1].lower()
-                if file_ext in ['.jpg', '.jpeg', '.png', '.gif', '.bmp'] and not tesseract_present:
-                    continue
+    for filename in file_paths:
+        try:
+            # Skip image files if Tesseract is not installed
+            file_ext = os.path.splitext(filename)[1].lower()
+            if file_ext in ['.jpg', '.jpeg', '.png', '.gif', '.bmp'] and not tesseract_present:
+                continue
 
-                strategy = "auto"
-                if file_ext == ".pdf":
-                    strategy = "hi_res" if poppler_present else "fast"
+            strategy = "auto"
+            if file_ext == ".pdf":
+                strategy = "hi_res" if poppler_present else "fast"
 
+            with metrics.FILE_READ_SECONDS.time(), profiling.stage("parse"):
                 elements = partition(filename=filename, strategy=strategy)
-                for element in elements:
-                    # Keep the original filename for display
-                    element.metadata.filename = os.path.basename(filename)
-                    # Add full path for unique identification and access
-                    element.metadata.file_path = filename
-                all_elements.extend(elements)
-            except Exception as e:
-                logger.error(f"Failed to process {filename} with Unstructured: {e}")
+            for element in elements:
+                # Keep the original filename for display
+                element.metadata.filename = os.path.basename(filename)
+                # Add full path for unique identification and access
+                element.metadata.file_path = filename
+            all_elements.extend(elements)
+        except Exception as e:
+            logger.error(f"Failed to process {filename} with Unstructured: {e}")
+    return all_elements
+
+def index_files_into(file_paths: list, collection, use_advanced_indexing: bool = False):
+    """Indexes the given files into one collection (or shard) with the standard or the advanced pipeline."""
+    if use_advanced_indexing:
+        logger.info("Using advanced indexing with Unstructured partition_auto.")
+        logger.info(f"Found {len(file_paths)} file(s) to process with Unstructured.")
+
+        all_elements = partition_files(file_paths)
 
         # This new function will handle the semantic chunking and indexing
         index_documents_unstructured(all_elements, collection)
 
     else:
         logger.info("Using standard indexing.")
-
-        # We must manually filter out temporary files for SimpleDirectoryReader
-        # by providing a list of files, as it doesn't support exclusion patterns directly.
-        files_to_process = []
-        if recursive:
-            for dirpath, _, filenames in os.walk(root_path):
-                for filename in filenames:
-                    if not filename.startswith('~$'):
-                        files_to_process.append(os.path.join(dirpath, filename))
-        else:
-            files_to_process = [os.path.join(root_path, f) for f in os.listdir(root_path) if os.path.isfile(os.path.join(root_path, f)) and not f.startswith('~$')]
-
-        # Filter by extension after collecting all files
-        input_files = [f for f in files_to_process if any(f.endswith(ext) for ext in required_exts)]
+        if not file_paths:
+            logger.info("No document to index.")
+            return
 
         reader = SimpleDirectoryReader(
-            input_files=input_files,
+            input_files=file_paths,
             errors='warn'
         )
 
-        documents = reader.load_data()
+        documents = []
+        # Files already extracted, e.g. to be summarized, are read from the text cache
+        docs_iterator = text_cache.iter_documents(reader)
+        while True:
+            with profiling.stage("parse"):
+                _, docs = next(docs_iterator, (None, None))
+            if docs is None:
+                break
+            documents.extend(docs)
         logger.info(f"Loaded {len(documents)} document(s) from the specified path.")
         index_documents(documents, collection)
 
-async def query_rag(query: str, collection, top_k: int = 5, prompt_template: str = None):
+def index_files(file_paths: list, use_advanced_indexing: bool = False, replace_existing: bool = False,
+                root_paths: list = None):
     """
-    Queries the RAG pipeline with an optional re-ranking step for the advanced collection,
-    and allows for a custom prompt template for the final response generation.
+    Indexes the given files into the standard or the advanced collection, shard by shard. With replace_existing,
+    the chunks previously indexed for these files are removed first, so modified files leave no stale chunks.
+    root_paths are the folders being indexed, used to name new shards with per-root sharding.
     """
-    query_embedding = model.encode(query, convert_to_tensor=False).tolist()
-
-    # For re-ranking, we fetch more initial results.
-    initial_results_count = top_k * 4 if collection.name == "file_embeddings_unstructured" else top_k
+    collection_name = "file_embeddings_unstructured" if use_advanced_indexing else "file_embeddings"
+    chroma_client = get_chroma_client()
 
-    results = collection.query(
-        query_embeddings=[query_embedding],
-        n_results=initial_results_count,
-        include=["documents", "metadatas", "distances"]
-    )
+    if replace_existing:
+        delete_file_chunks(file_paths, collection_names=[collection_name])
 
-    documents = results.get('documents', [[]])[0]
-    metadatas = results.get('metadatas', [[]])[0]
-    distances = results.get('distances', [[]])[0]
+    for shard_name, (shard_file_paths, shard_metadata) in assign_shards(chroma_client, collection_name, file_paths, root_paths).items():
+        logger.info(f"Using collection: {shard_name}")
+        collection = create_collection(chroma_client, name=shard_name, metadata=shard_metadata)
+        index_files_into(shard_file_paths, collection, use_advanced_indexing)
 
-    if not documents:
-        return {"main_response": {"response": "No relevant documents found.", "source": None}, "other_relevant_passages": []}
+async def index_files_from_path(root_path: str, recursive: bool, required_exts: list, use_advanced_indexing: bool = False):
+    """
+    Loads documents from a path and indexes them into ChromaDB. The chunks already indexed for these files are
+    replaced: their IDs depend on the file path and chunk order, so chunks of modified files, or of files moved
+    here (see rename_file_paths), would otherwise stay next to the new ones.
+    """
+    with profiling.stage("list_files"):
+        file_paths = list_files_to_index(root_path, recursive, required_exts)
+    profiling.count("files", len(file_paths))
+    index_files(file_paths, use_advanced_indexing, replace_existing=True, root_paths=[root_path])
 
+def select_results(documents: list, metadatas: list, distances: list, scores, top_k: int):
+    """
+    Turns the raw results of one query into the final passages: sorted by CrossEncoder score when
+    scores are given (advanced collection), otherwise filtered by distance margin. Both are deduplicated.
+    """
     # --- Re-ranking logic for the advanced pipeline ---
-    if collection.name == "file_embeddings_unstructured":
-        logger.info(f"Applying CrossEncoder re-ranking to {len(documents)} results.")
-        # Create pairs of [query, document] for scoring
-        sentence_pairs = [[query, doc] for doc in documents]
-
-        # Compute scores and sort
-        scores = cross_encoder.predict(sentence_pairs)
+    if scores is not None:
         scored_results = sorted(zip(scores, documents, metadatas), key=lambda x: x[0], reverse=True)
 
         # Reconstruct the results list with the top re-ranked items
@@ -371,6 +821,175 @@ async def query_rag(query: str, collection, top_k: int = 5, prompt_template: str
                 unique_results.append(res)
                 seen.add(identifier)
 
+    return unique_results
+
+def query_shards(shards: list, query_embeddings: list, n_results: int, where: dict = None):
+    """
+    Queries the shards of a collection concurrently and merges their results by distance,
+    in the format returned by collection.query.
+    """
+    def query(shard):
+        return shard.query(
+            query_embeddings=query_embeddings,
+            n_results=n_results,
+            where=where,
+            include=["documents", "metadatas", "distances"]
+        )
+
+    if len(shards) == 1:
+        return query(shards[0])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(shards), SHARD_QUERY_WORKERS)) as executor:
+        shard_results = list(executor.map(query, shards))
+
+    merged = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+    for query_index in range(len(query_embeddings)):
+        rows = []
+        for results in shard_results:
+            if results.get("documents"):
+                rows.extend(zip(results["distances"][query_index], results["documents"][query_index],
+                                results["metadatas"][query_index], results["ids"][query_index]))
+        rows = sorted(rows, key=lambda row: row[0])[:n_results]
+        merged["distances"].append([row[0] for row in rows])
+        merged["documents"].append([row[1] for row in rows])
+        merged["metadatas"].append([row[2] for row in rows])
+        merged["ids"].append([row[3] for row in rows])
+    return merged
+
+def lexical_query(query: str):
+    """
+    Turns a query into an FTS5 expression: each term is quoted, so identifiers such as INV-2023-001 or
+    report_v2.pdf match as a phrase instead of being parsed as operators, and any term may match.
+    Returns None when the query has no searchable term.
+    """
+    terms = ['"' + term.replace('"', '""') + '"' for term in query.split() if re.search(r"\w", term)]
+    return " OR ".join(terms) if terms else None
+
+def search_lexical(query: str, shards: list, limit: int, where: dict = None):
+    """
+    BM25 search of the lexical index, in the given shards. Returns the best chunks first, in the
+    format of select_results, with the score being the opposite of the BM25 rank (higher is better).
+    """
+    match_query = lexical_query(query)
+    if match_query is None:
+        return []
+    rows = get_thread_db().search_lexical_chunks([shard.name for shard in shards], match_query, limit, where)
+    return [{"id": chunk_id, "document": document, "metadata": metadata, "score": -rank}
+            for chunk_id, document, metadata, rank in rows]
+
+def fuse_results(ranked_lists: list, k: int = RRF_K):
+    """
+    Reciprocal-rank fusion: merges lists of results ranked by unrelated scores (distances, BM25) by
+    summing 1 / (k + rank) over the lists each chunk appears in. Returns the chunks by decreasing fused score.
+    """
+    fused = {}
+    for results in ranked_lists:
+        for rank, result in enumerate(results, start=1):
+            entry = fused.setdefault(result["id"], {**result, "score": 0.0})
+            entry["score"] += 1 / (k + rank)
+    return sorted(fused.values(), key=lambda result: result["score"], reverse=True)
+
+def rebuild_lexical_index(batch_size: int = 1000):
+    """
+    Fills the lexical index again from the documents stored in every shard, e.g. for chunks indexed
+    before it existed. Nothing is embedded. Returns the number of chunks.
+    """
+    chroma_client = get_chroma_client()
+    db = get_thread_db()
+    count = 0
+    for base_name in COLLECTION_NAMES:
+        for shard_name in list_shards(chroma_client, base_name):
+            collection = chroma_client.get_collection(shard_name)
+            db.delete_lexical_chunks(shard_name)
+            for start in range(0, collection.count(), batch_size):
+                records = collection.get(include=["documents", "metadatas"], limit=batch_size, offset=start)
+                db.upsert_lexical_chunks(base_name, shard_name, records["ids"], records["documents"], records["metadatas"])
+                count += len(records["ids"])
+    logger.info(f"Rebuilt the lexical index with {count} chunk(s)")
+    return count
+
+def retrieve_batch(queries: list, collection, top_k: int = 5, where: dict = None, mode: str = "dense"):
+    """
+    Retrieves the most relevant passages for several queries at once: the queries are encoded in one
+    forward pass, sent in a single Chroma query per shard, and re-ranked in a single CrossEncoder call for the
+    advanced collection. collection is a collection or the list of its shards (see get_search_collections).
+    Returns one list of results per query, None when the collection has no result at all.
+    The optional where filter (see build_where_filter) restricts the search to the matching chunks.
+    mode is one of SEARCH_MODES: "hybrid" fuses the dense results with the BM25 results of the lexical index,
+    "lexical" only searches the lexical index, without running the embedding model nor the CrossEncoder.
+    """
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode {mode}, expected one of {', '.join(SEARCH_MODES)}")
+    shards = collection if isinstance(collection, list) else [collection]
+    if not shards:
+        # No per-root shard can contain files under the path_prefix of the search
+        return [None for _ in queries]
+    rerank = base_collection_name(shards[0].name) == "file_embeddings_unstructured" and mode != "lexical"
+    # For re-ranking and fusion, we fetch more initial results.
+    initial_results_count = top_k if mode == "dense" and not rerank else top_k * 4
+
+    if mode == "lexical":
+        ranked = [search_lexical(query, shards, initial_results_count, where) for query in queries]
+    else:
+        with metrics.QUERY_EMBED_SECONDS.time():
+            query_embeddings = get_model().encode(queries, convert_to_tensor=False).tolist()
+        # Compact collections store projected vectors, so the queries must be projected the same way
+        projection = get_collection_projection(shards[0])
+        if projection is not None:
+            query_embeddings = projection.apply(query_embeddings).tolist()
+
+        with metrics.CHROMA_QUERY_SECONDS.time():
+            results = query_shards(shards, query_embeddings, initial_results_count, where)
+        ranked = [
+            [{"id": record_id, "document": document, "metadata": metadata, "distance": distance}
+             for record_id, document, metadata, distance in zip(ids, documents, metadatas, distances)]
+            for ids, documents, metadatas, distances in zip(
+                results.get('ids') or [[] for _ in queries],
+                results.get('documents') or [[] for _ in queries],
+                results.get('metadatas') or [[] for _ in queries],
+                results.get('distances') or [[] for _ in queries]
+            )
+        ]
+        if mode == "hybrid":
+            ranked = [
+                fuse_results([dense_results, search_lexical(query, shards, initial_results_count, where)])[:initial_results_count]
+                for query, dense_results in zip(queries, ranked)
+            ]
+
+    all_documents = [[result["document"] for result in results] for results in ranked]
+    all_metadatas = [[result["metadata"] for result in results] for results in ranked]
+    all_distances = [[result.get("distance") for result in results] for results in ranked]
+    # Lexical and fused results are ranked by score, dense results by distance
+    all_scores = [[result["score"] for result in results] if mode != "dense" else None for results in ranked]
+    if rerank:
+        # Create pairs of [query, document] for scoring, for all the queries at once
+        sentence_pairs = [[query, doc] for query, documents in zip(queries, all_documents) for doc in documents]
+        if sentence_pairs:
+            logger.info(f"Applying CrossEncoder re-ranking to {len(sentence_pairs)} results.")
+            with metrics.RERANK_SECONDS.time():
+                scores = get_cross_encoder().predict(sentence_pairs)
+            start = 0
+            for query_index, documents in enumerate(all_documents):
+                all_scores[query_index] = scores[start:start + len(documents)]
+                start += len(documents)
+
+    return [
+        select_results(documents, metadatas, distances, scores, top_k) if documents else None
+        for query, documents, metadatas, distances, scores
+        in zip(queries, all_documents, all_metadatas, all_distances, all_scores)
+    ]
+
+def retrieve(query: str, collection, top_k: int = 5, where: dict = None, mode: str = "dense"):
+    """
+    Retrieves the most relevant passages for a query, with an optional re-ranking step for the
+    advanced collection. Returns None when the collection has no result at all.
+    """
+    return retrieve_batch([query], collection, top_k, where, mode)[0]
+
+async def build_rag_response(query: str, unique_results, prompt_template: str = None):
+    """Generates the main response from the best passage and lists the other relevant passages."""
+    if unique_results is None:
+        return {"main_response": {"response": "No relevant documents found.", "source": None}, "other_relevant_passages": []}
+
     if not unique_results:
          return {"main_response": {"response": "No relevant documents found after filtering.", "source": None}, "other_relevant_passages": []}
 
@@ -395,3 +1014,27 @@ async def query_rag(query: str, collection, top_k: int = 5, prompt_template: str
         "main_response": main_response,
         "other_relevant_passages": other_relevant_passages
     }
+
+async def query_rag(query: str, collection, top_k: int = 5, prompt_template: str = None, where: dict = None,
+                    mode: str = "dense"):
+    """
+    Queries the RAG pipeline with an optional re-ranking step for the advanced collection,
+    and allows for a custom prompt template for the final response generation.
+    """
+    unique_results = retrieve(query, collection, top_k, where, mode)
+    return await build_rag_response(query, unique_results, prompt_template)
+
+async def query_rag_batch(queries: list, collection, top_k: int = 5, prompt_template: str = None,
+                          generate_response: bool = False, where: dict = None, mode: str = "dense"):
+    """
+    Queries the RAG pipeline for several queries with batched retrieval. Without generate_response,
+    only the passages of each query are returned, so no LLM call is made.
+    """
+    results = await asyncio.to_thread(retrieve_batch, queries, collection, top_k, where, mode)
+    if not generate_response:
+        return [{"query": query, "passages": unique_results or []} for query, unique_results in zip(queries, results)]
+    responses = await asyncio.gather(*[
+        build_rag_response(query, unique_results, prompt_template)
+        for query, unique_results in zip(queries, results)
+    ])
+    return [{"query": query, **response} for query, response in zip(queries, responses)]
@@ -5,12 +5,17 @@ from llama_index.core.node_parser import TokenTextSplitter
 import os
 import logging
 from pathlib import Path
-import hashlib
+import uuid
 
 from .database import SQLiteDB
 from .settings import CustomFormatter
-from .settings import Model
+from .settings import Model, Settings
 from . import rag_utils
+from . import organizer
+from . import metrics
+from . import profiling
+from . import text_cache
+from .text_cache import get_file_hash
 import shutil
 
 logger = logging.getLogger()
@@ -21,16 +26,26 @@ ch.setFormatter(CustomFormatter())
 logger.addHandler(ch)
 db = SQLiteDB()
 
+# Documents are truncated to this many tokens before being summarized
+SUMMARY_MAX_TOKENS = 6144
+
 
 async def summarize_document(doc: Document):
     logger.info(f"Processing file {doc.metadata['file_path']}")
-    doc_hash = get_file_hash(doc.metadata['file_path'])
+    doc_hash = doc.metadata.get('file_hash') or get_file_hash(doc.metadata['file_path'])
     if db.is_file_exist(doc.metadata['file_path'], doc_hash):
+        metrics.SUMMARY_CACHE_HITS.inc()
         summary = db.get_file_summary(doc.metadata['file_path'])
     else:
+        metrics.SUMMARY_CACHE_MISSES.inc()
+        profiling.count("llm_summaries")
         model = Model()
         summary = await model.summarize_document_api(doc.text)
-        db.insert_file_summary(doc.metadata['file_path'], doc_hash, summary)
+        # An empty summary means the LLM requests failed: it is asked again next time
+        if summary:
+            db.insert_file_summary(doc.metadata['file_path'], doc_hash, summary)
+        else:
+            logger.warning(f"Could not summarize {doc.metadata['file_path']}, its summary is not cached")
     return {
         "file_path": doc.metadata['file_path'],
         "summary": summary
@@ -39,13 +54,20 @@ async def summarize_document(doc: Document):
 
 async def summarize_image_document(doc: ImageDocument):
     logger.info(f"Processing image {doc.image_path}")
-    image_hash = get_file_hash(doc.image_path)
+    image_hash = doc.metadata.get('file_hash') or get_file_hash(doc.image_path)
     if db.is_file_exist(doc.image_path, image_hash):
+        metrics.SUMMARY_CACHE_HITS.inc()
         summary = db.get_file_summary(doc.image_path)
     else:
+        metrics.SUMMARY_CACHE_MISSES.inc()
+        profiling.count("llm_summaries")
         model = Model()
-        summary = await model.summarize_image_api(image_path=doc.image_path)
-        db.insert_file_summary(doc.image_path, image_hash, summary)
+        summary = await model.summarize_image_api(image_path=doc.image_path, image_hash=image_hash)
+        # An empty summary means the LLM requests failed: it is asked again next time
+        if summary:
+            db.insert_file_summary(doc.image_path, image_hash, summary)
+        else:
+            logger.warning(f"Could not summarize {doc.image_path}, its summary is not cached")
     return {
         "file_path": doc.image_path,
         "summary": summary
@@ -68,10 +90,52 @@ async def get_summaries(documents):
     return docs_summaries
 
 
-async def remove_deleted_files():
-    file_paths = db.get_all_files()
-    deleted_file_paths = [file_path for file_path in file_paths if not os.path.exists(file_path)]
-    db.delete_records(deleted_file_paths)
+def list_files_on_disk(root_path, recursive):
+    file_paths = set()
+    for dirpath, _, filenames in os.walk(root_path):
+        file_paths.update(os.path.join(dirpath, filename) for filename in filenames)
+        if not recursive:
+            break
+    return file_paths
+
+
+async def remove_deleted_files(root_path, recursive):
+    # Compare what is on disk under the scanned root with what is cached for it,
+    # instead of checking every cached path one by one.
+    root_path = os.path.normpath(root_path)
+    file_paths = await asyncio.to_thread(list_files_on_disk, root_path, recursive)
+    cached_file_paths = db.get_files_under(root_path)
+    if not recursive:
+        cached_file_paths = [file_path for file_path in cached_file_paths
+                             if os.path.dirname(file_path) == root_path]
+    deleted_file_paths = [file_path for file_path in cached_file_paths if file_path not in file_paths]
+    if deleted_file_paths:
+        db.delete_records(deleted_file_paths)
+        await asyncio.to_thread(rag_utils.delete_file_chunks, deleted_file_paths)
+        logger.info(f"Removed {len(deleted_file_paths)} deleted file(s) under {root_path}")
+
+
+def read_documents(reader: SimpleDirectoryReader):
+    splitter = TokenTextSplitter(chunk_size=SUMMARY_MAX_TOKENS)
+
+    def prepare(docs):
+        # By default, llama index split files into multiple "documents"
+        if len(docs) == 1:
+            return docs
+        try:
+            # So we first join all the document contexts, then truncate by token count
+            text = splitter.split_text("\n".join([d.text for d in docs]))[0]
+            return [Document(text=text, metadata=docs[0].metadata)]
+        except Exception as e:
+            logger.error(f"Error reading file {docs[0].metadata['file_path']} \n")  # , e.args)
+            return []
+
+    documents = []
+    for file_hash, docs in text_cache.iter_documents(reader, text_cache.summary_kind(SUMMARY_MAX_TOKENS), prepare):
+        # Hashed once, summarize_document doesn't need to read the file again
+        docs[0].metadata["file_hash"] = file_hash
+        documents.append(docs[0])
+    return documents
 
 
 def load_documents(path: str, recursive: bool, required_exts: list):
@@ -81,27 +145,33 @@ def load_documents(path: str, recursive: bool, required_exts: list):
         required_exts=required_exts,
         errors='ignore'
     )
-    splitter = TokenTextSplitter(chunk_size=6144)
-    documents = []
-    for docs in reader.iter_data():
-        # By default, llama index split files into multiple "documents"
-        if len(docs) > 1:
-            try:
-                # So we first join all the document contexts, then truncate by token count
-                text = splitter.split_text("\n".join([d.text for d in docs]))[0]
-                documents.append(Document(text=text, metadata=docs[0].metadata))
-            except Exception as e:
-                logger.error(f"Error reading file {docs[0].metadata['file_path']} \n")  # , e.args)
-        else:
-            documents.append(docs[0])
-    return documents
+    return read_documents(reader)
+
+
+def load_files(file_paths: list):
+    reader = SimpleDirectoryReader(
+        input_files=file_paths,
+        errors='ignore'
+    )
+    return read_documents(reader)
+
+
+async def summarize_files(file_paths: list):
+    if not file_paths:
+        return []
+    documents = await asyncio.to_thread(load_files, file_paths)
+    return await get_summaries(documents)
 
 
 async def get_dir_summaries(path: str, recursive: bool, required_exts: list):
-    doc_dicts = load_documents(path, recursive, required_exts)
+    with profiling.stage("load_documents"):
+        doc_dicts = load_documents(path, recursive, required_exts)
+    profiling.count("files", len(doc_dicts))
 
-    await remove_deleted_files()
-    files_summaries = await get_summaries(doc_dicts)
+    with profiling.stage("prune"):
+        await remove_deleted_files(path, recursive)
+    with profiling.stage("summarize"):
+        files_summaries = await get_summaries(doc_dicts)
 
     # Convert path to relative path
     for summary in files_summaries:
@@ -114,8 +184,17 @@ async def run(directory_path: str, recursive: bool, required_exts: list):
     logger.info("Starting ...")
 
     summaries = await get_dir_summaries(directory_path, recursive, required_exts)
-    model = Model()
-    files = await model.create_file_tree_api(summaries)
+    settings = Settings()
+    with profiling.stage("organize"):
+        if settings.ORGANIZER_MODE == "cluster":
+            files = await organizer.create_file_tree(
+                summaries,
+                max_files_per_folder=settings.CLUSTER_MAX_FILES_PER_FOLDER,
+                max_depth=settings.CLUSTER_MAX_DEPTH
+            )
+        else:
+            model = Model()
+            files = await model.create_file_tree_api(summaries)
 
     # Recursively create dictionary from file paths
     tree = {}
@@ -128,21 +207,92 @@ async def run(directory_path: str, recursive: bool, required_exts: list):
     return files
 
 
-def update_file(root_path, item):
-    src_file = root_path + "/" + item["src_path"]
-    dst_file = root_path + "/" + item["dst_path"]
-    dst_dir = os.path.dirname(dst_file)
-    if not os.path.exists(dst_dir):
-        os.makedirs(dst_dir)
-    if os.path.isfile(src_file):
-        shutil.move(src_file, dst_file)
-        new_hash = get_file_hash(dst_file)
-        db.update_file(src_file, dst_file, new_hash)
-
-
-def get_file_hash(file_path):
-    hash_func = hashlib.new('sha256')
-    with open(file_path, 'rb') as f:
-        while chunk := f.read(8192):
-            hash_func.update(chunk)
-    return hash_func.hexdigest()
+def plan_moves(root_path, items):
+    moves = {}
+    destinations = {}
+    for item in items:
+        src_file = os.path.normpath(os.path.join(root_path, item["src_path"]))
+        dst_file = os.path.normpath(os.path.join(root_path, item["dst_path"]))
+        if src_file == dst_file or not os.path.isfile(src_file):
+            continue
+        if src_file in moves:
+            raise ValueError(f"File is moved more than once: {src_file}")
+        if dst_file in destinations:
+            raise ValueError(f"Files {destinations[dst_file]} and {src_file} are both moved to {dst_file}")
+        moves[src_file] = dst_file
+        destinations[dst_file] = src_file
+
+    # A destination can only be occupied by a file which is itself moved away
+    for dst_file in destinations:
+        if os.path.exists(dst_file) and dst_file not in moves:
+            raise ValueError(f"Destination already exists: {dst_file}")
+    return moves
+
+
+def schedule_moves(moves):
+    # Sources and destinations are unique, so a move waiting for its destination to be freed
+    # belongs either to a chain (a -> b, b -> c) or to a cycle (a -> b, b -> a).
+    # Cycles are broken by first parking one of their files under a temporary name.
+    staging = {}
+    pending = dict(moves)
+    visited = set()
+    for start in moves:
+        path = start
+        chain = []
+        while path in moves and path not in visited:
+            visited.add(path)
+            chain.append(path)
+            path = moves[path]
+        if path in chain:
+            tmp_file = os.path.join(os.path.dirname(path),
+                                    f".{os.path.basename(path)}.{uuid.uuid4().hex[:8]}.move")
+            staging[path] = tmp_file
+            pending[tmp_file] = pending.pop(path)
+
+    waves = [staging] if staging else []
+    # Each wave only contains moves whose destination has already been freed
+    while pending:
+        wave = {src: dst for src, dst in pending.items() if dst not in pending}
+        waves.append(wave)
+        for src in wave:
+            del pending[src]
+    return staging, waves
+
+
+def move_file(src_file, dst_file):
+    os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+    shutil.move(src_file, dst_file)
+
+
+async def move_files(root_path, items):
+    moves = plan_moves(root_path, items)
+    staging, waves = schedule_moves(moves)
+    parked = {tmp_file: src_file for src_file, tmp_file in staging.items()}
+    done = set()
+    error = None
+    for wave in waves:
+        results = await asyncio.gather(
+            *[asyncio.to_thread(move_file, src, dst) for src, dst in wave.items()],
+            return_exceptions=True
+        )
+        for (src, dst), result in zip(wave.items(), results):
+            if isinstance(result, Exception):
+                logger.error(f"Error moving file {src} to {dst}: {result}")
+                error = error or result
+            elif src not in staging:
+                done.add(parked.get(src, src))
+        if error:
+            break
+
+    # Put back the files parked for a cycle which could not be completed
+    for tmp_file, src_file in parked.items():
+        if src_file not in done and os.path.exists(tmp_file) and not os.path.exists(src_file):
+            shutil.move(tmp_file, src_file)
+
+    renames = {src_file: moves[src_file] for src_file in done}
+    db.move_files(renames)
+    await asyncio.to_thread(rag_utils.rename_file_paths, renames)
+    logger.info(f"Moved {len(renames)} file(s) in {len(waves)} wave(s)")
+    if error:
+        raise error
+    return renames
@@ -1,23 +1,70 @@
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from .run import run, update_file
+from .run import run, move_files, db
 from . import rag_utils
+from . import embedding_pool
+from . import image_preprocessing
+from . import metrics
+from . import planner
+from . import profiling
+from . import text_cache
+from .settings import Settings
+from .watcher import FileWatcher
 import os
 import subprocess
 import platform
 import base64
+import json
 import mimetypes
 import asyncio
 from fastapi import Response
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse
+import logging
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
+def acquire_watcher_lock():
+    """
+    With several uvicorn workers, only the first one to take this lock runs the file watcher.
+    The lock is released when the worker exits.
+    """
+    import fcntl
+
+    app.state.watcher_lock = open("watcher.lock", "w")
+    try:
+        fcntl.flock(app.state.watcher_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        app.state.watcher_lock.close()
+        return False
+    return True
+
 @app.on_event("startup")
 async def startup_event():
     # This will run in a separate thread to not block the server startup.
     asyncio.create_task(rag_utils.warm_up_unstructured())
+    # The models are loaded on first use otherwise, which would slow down the first search
+    asyncio.create_task(asyncio.to_thread(rag_utils.load_models))
+    removed = db.delete_extracted_text(text_cache.READER_VERSION)
+    if removed:
+        logger.info(f"Removed {removed} cached text(s) extracted by older readers")
+    app.state.watcher = None
+    settings = Settings()
+    if settings.WATCH_ROOTS:
+        if platform.system() != "Linux":
+            logger.warning("Watch mode relies on inotify and is only available on Linux.")
+        elif acquire_watcher_lock():
+            app.state.watcher = FileWatcher.from_settings(settings)
+            await app.state.watcher.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if app.state.watcher:
+        await app.state.watcher.stop()
+    embedding_pool.close_pool()
+    image_preprocessing.close_executor()
 
 app.add_middleware(
     CORSMiddleware,
@@ -35,14 +82,21 @@ def get_angular_app():
 
 
 @app.get("/get_files")
-async def get_files(root_path: str, recursive: bool, required_exts: str):
+async def get_files(root_path: str, recursive: bool, required_exts: str, dry_run: bool = False):
     if not os.path.exists(root_path):
         return HTTPException(status_code=404, detail=f"Path doesn't exist: {root_path}")
     required_exts = required_exts.split(';')
-    files = await run(root_path, recursive, required_exts)
+    if dry_run:
+        plan = await asyncio.to_thread(planner.plan_get_files, root_path, recursive, required_exts)
+        return {"root_path": root_path, "plan": plan}
+    with profiling.job("get_files", root_path=root_path, recursive=recursive) as job:
+        files = await run(root_path, recursive, required_exts)
+    timings = job.report()
+    db.insert_job_report(timings)
     return {
         "root_path": root_path,
-        "items": files
+        "items": files,
+        "timings": timings
     }
 
 
@@ -51,12 +105,13 @@ async def update_files(request: Request):
     data = await request.json()
     root_path = data.get('root_path')
     items = data.get('items')
-    for item in items:
-        try:
-            update_file(root_path, item)
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error while moving file: {e}")
-    return {"message": "Files moved successfully"}
+    try:
+        moved = await move_files(root_path, items)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid file moves: {e}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error while moving file: {e}")
+    return {"message": "Files moved successfully", "moved_count": len(moved)}
 
 
 @app.post("/open_file")
@@ -108,13 +163,61 @@ async def download_file(encoded_path: str):
     return FileResponse(file_path, media_type=media_type, headers=headers)
 
 
+def get_where_filter(path_prefix=None, exts=None, page_min=None, page_max=None, modified_after=None,
+                     modified_before=None):
+    if isinstance(exts, str):
+        exts = [ext for ext in exts.split(';') if ext]
+    try:
+        return rag_utils.build_where_filter(path_prefix, exts, page_min, page_max, modified_after, modified_before)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid search filter: {e}")
+
+def check_search_mode(mode):
+    if mode not in rag_utils.SEARCH_MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of {', '.join(rag_utils.SEARCH_MODES)}")
+    return mode
+
 @app.get("/rag_search")
-async def rag_search(query: str, collection_name: str = "file_embeddings", top_k: int = 5, prompt_template: str = None):
+async def rag_search(query: str, collection_name: str = "file_embeddings", top_k: int = 5, prompt_template: str = None,
+                     path_prefix: str = None, exts: str = None, page_min: int = None, page_max: int = None,
+                     modified_after: str = None, modified_before: str = None, mode: str = "dense"):
+    check_search_mode(mode)
+    where = get_where_filter(path_prefix, exts, page_min, page_max, modified_after, modified_before)
     chroma_client = rag_utils.get_chroma_client()
-    collection = rag_utils.create_collection(chroma_client, name=collection_name)
-    result = await rag_utils.query_rag(query, collection, top_k, prompt_template)
+    collection = rag_utils.get_search_collections(chroma_client, collection_name, path_prefix)
+    result = await rag_utils.query_rag(query, collection, top_k, prompt_template, where, mode)
     return result
 
+@app.post("/rag_search_batch")
+async def rag_search_batch(request: Request):
+    data = await request.json()
+    queries = data.get('queries') or []
+    collection_name = data.get('collection_name', "file_embeddings")
+    top_k = data.get('top_k', 5)
+    if not queries or not all(isinstance(query, str) and query for query in queries):
+        raise HTTPException(status_code=400, detail="queries must be a non-empty list of strings")
+    mode = check_search_mode(data.get('mode', "dense"))
+    where = get_where_filter(
+        data.get('path_prefix'),
+        data.get('exts'),
+        data.get('page_min'),
+        data.get('page_max'),
+        data.get('modified_after'),
+        data.get('modified_before')
+    )
+    chroma_client = rag_utils.get_chroma_client()
+    collection = rag_utils.get_search_collections(chroma_client, collection_name, data.get('path_prefix'))
+    results = await rag_utils.query_rag_batch(
+        queries,
+        collection,
+        top_k,
+        prompt_template=data.get('prompt_template'),
+        generate_response=data.get('generate_response', False),
+        where=where,
+        mode=mode
+    )
+    return {"results": results}
+
 @app.post("/index_files")
 async def index_files(request: Request):
     data = await request.json()
@@ -127,13 +230,21 @@ async def index_files(request: Request):
         return HTTPException(status_code=404, detail=f"Path doesn't exist: {root_path}")
 
     required_exts = required_exts.split(';') if required_exts else []
-    await rag_utils.index_files_from_path(
-        root_path=root_path,
-        recursive=recursive,
-        required_exts=required_exts,
-        use_advanced_indexing=use_advanced_indexing
-    )
-    return {"message": "Files indexed successfully"}
+    if data.get('dry_run', False):
+        plan = await asyncio.to_thread(planner.plan_index_files, root_path, recursive, required_exts,
+                                       use_advanced_indexing)
+        return {"root_path": root_path, "plan": plan}
+    with profiling.job("index_files", root_path=root_path, recursive=recursive,
+                       use_advanced_indexing=use_advanced_indexing) as job:
+        await rag_utils.index_files_from_path(
+            root_path=root_path,
+            recursive=recursive,
+            required_exts=required_exts,
+            use_advanced_indexing=use_advanced_indexing
+        )
+    timings = job.report()
+    db.insert_job_report(timings)
+    return {"message": "Files indexed successfully", "timings": timings}
 
 
 @app.get("/llm_providers")
@@ -190,6 +301,16 @@ async def update_llm_config(request: Request):
         f'IMAGE_MODEL_NAME="{data["image_model"]}"\n'
         f'IMAGE_API_KEYS={json.dumps(data["image_api_keys"])}\n'
     )
+
+    # Keep the other settings (watch mode, ...) which are not edited from the UI
+    llm_settings = {"TEXT_API_END_POINT", "TEXT_MODEL_NAME", "TEXT_API_KEYS",
+                    "IMAGE_API_END_POINT", "IMAGE_MODEL_NAME", "IMAGE_API_KEYS"}
+    if os.path.exists('.env'):
+        with open('.env') as f:
+            other_settings = [line for line in f.read().splitlines()
+                              if "=" in line and line.split("=", 1)[0].strip() not in llm_settings]
+        if other_settings:
+            env_content += "\n" + "\n".join(other_settings) + "\n"
     
     # Write to .env file
     try:
@@ -224,6 +345,59 @@ async def get_current_llm_config():
         }
 
 
+@app.get("/metrics")
+async def get_metrics():
+    content, media_type = metrics.render()
+    return Response(content=content, media_type=media_type)
+
+
+@app.get("/admin/profile")
+async def profile(seconds: float = 10, interval_ms: float = 10):
+    """Samples the stacks of the running process and returns them in the folded (flamegraph) format."""
+    if not 0 < seconds <= 300 or interval_ms < 1:
+        raise HTTPException(status_code=400, detail="seconds must be in ]0, 300] and interval_ms >= 1")
+    folded_stacks = await asyncio.to_thread(profiling.sample_stacks, seconds, interval_ms / 1000)
+    return PlainTextResponse(folded_stacks)
+
+
+@app.get("/admin/jobs")
+async def get_job_reports(kind: str = None, limit: int = 50):
+    return {"jobs": db.get_job_reports(kind, limit)}
+
+
+@app.get("/admin/jobs/{job_id}")
+async def get_job_report(job_id: str):
+    report = db.get_job_report(job_id)
+    if report is None:
+        raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+    return report
+
+
+@app.get("/admin/shards")
+async def list_shards():
+    return {"shards": await asyncio.to_thread(rag_utils.describe_shards)}
+
+
+@app.delete("/admin/shards/{name}")
+async def drop_shard(name: str):
+    if not await asyncio.to_thread(rag_utils.drop_shard, name):
+        raise HTTPException(status_code=404, detail=f"Shard not found: {name}")
+    return {"message": f"Shard {name} dropped"}
+
+
+@app.post("/admin/shards/{name}/rebuild")
+async def rebuild_shard(name: str, reembed: bool = False):
+    if not await asyncio.to_thread(rag_utils.rebuild_shard, name, reembed):
+        raise HTTPException(status_code=404, detail=f"Shard not found: {name}")
+    return {"message": f"Shard {name} rebuilt"}
+
+
+@app.post("/admin/lexical_index/rebuild")
+async def rebuild_lexical_index():
+    count = await asyncio.to_thread(rag_utils.rebuild_lexical_index)
+    return {"message": f"Lexical index rebuilt with {count} chunk(s)"}
+
+
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"}
@@ -1,13 +1,16 @@
+import asyncio
 import time
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pydantic import Field
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 import base64
 import logging
 import json
 import sys
 import requests
+from . import image_preprocessing
+from . import metrics
 import logging
 
 logger = logging.getLogger()
@@ -21,6 +24,45 @@ class Settings(BaseSettings):
     IMAGE_API_END_POINT: str = ""
     IMAGE_MODEL_NAME: str = ""
     IMAGE_API_KEYS: list[str] = Field(default_factory=list)
+    # Watch mode: keep summaries and embeddings of these folders up to date (Linux only)
+    WATCH_ROOTS: list[str] = Field(default_factory=list)
+    WATCH_EXTS: list[str] = Field(default_factory=lambda: [".pdf", ".docx", ".txt", ".md", ".png", ".jpg", ".jpeg"])
+    WATCH_RECURSIVE: bool = True
+    WATCH_DEBOUNCE_SECONDS: float = 2.0
+    WATCH_SUMMARIZE: bool = True
+    WATCH_INDEX: bool = True
+    WATCH_ADVANCED_INDEXING: bool = False
+    # Multi-process embedding for /index_files (disabled below 2 workers)
+    EMBEDDING_WORKERS: int = 0
+    EMBEDDING_WORKER_THREADS: int = 0
+    # How /get_files proposes the new tree: "llm" (summaries sent to the LLM) or "cluster" (local clustering)
+    ORGANIZER_MODE: str = "llm"
+    CLUSTER_MAX_FILES_PER_FOLDER: int = 12
+    CLUSTER_MAX_DEPTH: int = 3
+    # Split the Chroma collections into shards: "none", "root" (one shard per indexed folder) or "hash"
+    COLLECTION_SHARDING: str = "none"
+    COLLECTION_SHARDS: int = 8
+    # HNSW index of new collections and shards, with overrides per collection, e.g.
+    # {"file_embeddings_unstructured": {"search_ef": 200}}
+    HNSW_SPACE: str = "l2"
+    HNSW_CONSTRUCTION_EF: int = 100
+    HNSW_SEARCH_EF: int = 100
+    HNSW_M: int = 16
+    HNSW_COLLECTION_CONFIG: dict[str, dict] = Field(default_factory=dict)
+    # Compact vectors of new collections: "none", "pca" or "truncate" to COMPACT_DIMENSIONS dimensions
+    COMPACT_VECTORS: str = "none"
+    COMPACT_DIMENSIONS: int = 128
+    COMPACT_FIT_SAMPLE: int = 5000
+    # Unix socket of the shared inference service (python -m app.inference_service), empty to load the models in-process
+    INFERENCE_SERVICE_SOCKET: str = ""
+    INFERENCE_MAX_BATCH_SIZE: int = 64
+    INFERENCE_BATCH_WAIT_MS: float = 5.0
+    INFERENCE_TIMEOUT_SECONDS: float = 120.0
+    # Images are downscaled and re-encoded before being sent to the vision model, and cached by content hash
+    IMAGE_MAX_SIDE: int = 1024
+    IMAGE_JPEG_QUALITY: int = 85
+    IMAGE_PREPROCESS_WORKERS: int = 2
+    IMAGE_CACHE_DIR: str = "image_cache"
 
 class Model:
     def __init__(self):
@@ -39,41 +81,68 @@ class Model:
         # Lazy init: crée les clients seulement si des clés existent
         self.async_text_clients = []
         self.async_image_clients = []
+        # The SDK retries with backoff on its own, the HTTP hooks count these retries and the 429s
         if self.text_keys_count:
-            self.async_text_clients = [AsyncOpenAI(base_url=self.TEXT_API_END_POINT, api_key=k)
-                                       for k in self.TEXT_API_KEYS]
+            self.async_text_clients = [
+                AsyncOpenAI(base_url=self.TEXT_API_END_POINT, api_key=k,
+                            http_client=DefaultAsyncHttpxClient(event_hooks=metrics.llm_event_hooks(f"text_{i}")))
+                for i, k in enumerate(self.TEXT_API_KEYS)
+            ]
         if self.image_keys_count:
-            self.async_image_clients = [AsyncOpenAI(base_url=self.IMAGE_API_END_POINT, api_key=k)
-                                        for k in self.IMAGE_API_KEYS]
+            self.async_image_clients = [
+                AsyncOpenAI(base_url=self.IMAGE_API_END_POINT, api_key=k,
+                            http_client=DefaultAsyncHttpxClient(event_hooks=metrics.llm_event_hooks(f"image_{i}")))
+                for i, k in enumerate(self.IMAGE_API_KEYS)
+            ]
+
+    async def load_image(self, image_path, image_hash=None):
+        with metrics.IMAGE_PREPROCESS_SECONDS.time():
+            return await image_preprocessing.load_image(
+                image_path,
+                image_hash,
+                max_side=self.settings.IMAGE_MAX_SIDE,
+                quality=self.settings.IMAGE_JPEG_QUALITY,
+                cache_dir=self.settings.IMAGE_CACHE_DIR,
+                workers=self.settings.IMAGE_PREPROCESS_WORKERS,
+            )
 
-    async def summarize_image_api(self, image_path):
+    async def summarize_image_api(self, image_path, image_hash=None):
         prompt = """
         Describe this image in the most concise way possible, capturing only the essential elements and details. 
         Aim for a very brief yet accurate summary.
         """
         attempt = 0
         summary = ""
+        image_data, mime_type = await self.load_image(image_path, image_hash)
         # Huggingface API doesn't support image completions
         if "huggingface.co" in self.IMAGE_API_END_POINT.lower():
             # To avoid rate_limit_exceeded or api error
             endpoint_url = self.IMAGE_API_END_POINT.replace("v1", "models") + "/" + self.IMAGE_MODEL_NAME
             while attempt < 5:
+                key = f"image_{self.cnt_img % max(self.image_keys_count, 1)}"
+                start = time.perf_counter()
                 try:
-                    headers = {"Authorization": f"Bearer {self.IMAGE_API_KEYS[self.cnt_img % self.image_keys_count]}"}
-                    with open(image_path, "rb") as f:
-                        data = f.read()
-                        response = requests.post(endpoint_url, headers=headers, data=data)
+                    headers = {
+                        "Authorization": f"Bearer {self.IMAGE_API_KEYS[self.cnt_img % self.image_keys_count]}",
+                        "Content-Type": mime_type
+                    }
+                    response = requests.post(endpoint_url, headers=headers, data=image_data)
+                    response.raise_for_status()
                     summary = response.json()[0]["generated_text"]
+                    metrics.observe_llm_call("summarize_image", key, time.perf_counter() - start)
                     break
                 except Exception as e:
                     logger.error("Error {}".format(e))
                     attempt += 1
+                    metrics.observe_llm_error("summarize_image", key, e, retried=attempt < 5)
                     self.cnt_img += 1
         else:
-            with open(image_path, "rb") as image_file:
-                base64_image = base64.b64encode(image_file.read()).decode('utf-8')
+            base64_image = base64.b64encode(image_data).decode('utf-8')
             # To avoid rate_limit_exceeded or api error
+            metrics.LLM_OPERATION.set("summarize_image")
             while attempt < 5:
+                key = f"image_{self.cnt_img % max(self.image_keys_count, 1)}"
+                start = time.perf_counter()
                 try:
                     chat_completion = await self.async_image_clients[
                         self.cnt_img % self.image_keys_count].chat.completions.create(
@@ -86,7 +155,7 @@ class Model:
                                     {
                                         "type": "image_url",
                                         "image_url": {
-                                            "url": f"data:image/jpeg;base64,{base64_image}"
+                                            "url": f"data:{mime_type};base64,{base64_image}"
                                         },
                                     },
                                 ],
@@ -96,10 +165,13 @@ class Model:
                         temperature=0,
                     )
                     summary = chat_completion.choices[0].message.content
+                    metrics.observe_llm_call("summarize_image", key, time.perf_counter() - start,
+                                             chat_completion.usage)
                     break
                 except Exception as e:
                     logger.error("Error {}".format(e))
                     attempt += 1
+                    metrics.observe_llm_error("summarize_image", key, e, retried=attempt < 5, counted_by_hooks=True)
                     self.cnt_img += 1
         return summary
 
@@ -113,7 +185,10 @@ class Model:
         attempt = 0
         summary = ""
         # To avoid rate_limit_exceeded or api error
+        metrics.LLM_OPERATION.set("summarize_document")
         while attempt < 5:
+            key = f"text_{self.cnt_txt % max(self.text_keys_count, 1)}"
+            start = time.perf_counter()
             try:
                 chat_completion = await self.async_text_clients[
                     self.cnt_txt % self.text_keys_count].chat.completions.create(
@@ -127,10 +202,12 @@ class Model:
                     timeout=None,
                 )
                 summary = chat_completion.choices[0].message.content
+                metrics.observe_llm_call("summarize_document", key, time.perf_counter() - start, chat_completion.usage)
                 break
             except Exception as e:
                 logger.error("Error {}".format(e))
                 attempt += 1
+                metrics.observe_llm_error("summarize_document", key, e, retried=attempt < 5, counted_by_hooks=True)
                 self.cnt_txt += 1
         return summary
 
@@ -158,7 +235,10 @@ class Model:
         attempt = 0
         summary = ""
         # To avoid rate_limit_exceeded or api error
+        metrics.LLM_OPERATION.set("generate_rag_response")
         while attempt < 5:
+            key = f"text_{self.cnt_txt % max(self.text_keys_count, 1)}"
+            start = time.perf_counter()
             try:
                 chat_completion = await self.async_text_clients[
                     self.cnt_txt % self.text_keys_count].chat.completions.create(
@@ -172,10 +252,12 @@ class Model:
                     timeout=None,
                 )
                 summary = chat_completion.choices[0].message.content
+                metrics.observe_llm_call("generate_rag_response", key, time.perf_counter() - start, chat_completion.usage)
                 break
             except Exception as e:
                 logger.error("Error {}".format(e))
                 attempt += 1
+                metrics.observe_llm_error("generate_rag_response", key, e, retried=attempt < 5, counted_by_hooks=True)
                 self.cnt_txt += 1
         return summary
 
@@ -220,7 +302,10 @@ class Model:
         """.strip()
         attempt = 0
         file_tree = []  # Initialize as empty list
+        metrics.LLM_OPERATION.set("create_file_tree")
         while attempt < 10:
+            key = f"text_{self.cnt_txt % max(self.text_keys_count, 1)}"
+            start = time.perf_counter()
             try:
                 chat_completion = await self.async_text_clients[
                     self.cnt_txt % self.text_keys_count].chat.completions.create(
@@ -233,6 +318,7 @@ class Model:
                     temperature=0,
                 )
                 result = chat_completion.choices[0].message.content
+                metrics.observe_llm_call("create_file_tree", key, time.perf_counter() - start, chat_completion.usage)
                 # case when llm doesn't support llama json template
                 result = result.replace("```json", "").replace("```", "").strip()
                 file_tree = json.loads(result)["files"]
@@ -240,10 +326,76 @@ class Model:
             except Exception as e:
                 logger.error("Error {}".format(e))
                 attempt += 1
+                metrics.observe_llm_error("create_file_tree", key, e, retried=attempt < 10, counted_by_hooks=True)
                 self.cnt_txt += 1
                 time.sleep(2)
         return file_tree  # Will return empty list if all attempts fail
 
+    async def name_folders_api(self, folders: list):
+        tmp: list = []
+        names: dict = {}
+        for folder in folders:
+            # it's better to use tiktoken here
+            if tmp and (sys.getsizeof(json.dumps(tmp)) + sys.getsizeof(json.dumps(folder))) / 4 >= self.MAX_TOKEN_SIZE:
+                names.update(await self.name_folders_api_chunk(tmp))
+                tmp = []
+            tmp.append(folder)
+        if len(tmp) > 0:
+            names.update(await self.name_folders_api_chunk(tmp))
+        return names
+
+    async def name_folders_api_chunk(self, folders: list):
+        folder_prompt = """
+        You will be provided with a list of folders. Each folder has an id, the id of its parent folder (null for top level folders)
+        and the summaries of a few representative files it contains.
+        For each folder, propose a short and descriptive folder name following known conventions and best practices.
+        - The name must describe what the files of the folder have in common
+        - A sub folder name must be more specific than its parent folder name, don't repeat the parent name
+        - Avoid spaces or special characters, use lowercase words separated by underscores
+
+        Your response must be a JSON object with the following schema, dont add any extra text except the json:
+        ```json
+        {
+            "folders": [
+                {
+                    "id": "folder id",
+                    "name": "proposed folder name"
+                }
+            ]
+        }
+        ```
+        """.strip()
+        attempt = 0
+        names = {}
+        metrics.LLM_OPERATION.set("name_folders")
+        while attempt < 10:
+            key = f"text_{self.cnt_txt % max(self.text_keys_count, 1)}"
+            start = time.perf_counter()
+            try:
+                chat_completion = await self.async_text_clients[
+                    self.cnt_txt % self.text_keys_count].chat.completions.create(
+                    messages=[
+                        {"role": "system", "content": folder_prompt},
+                        {"role": "user", "content": json.dumps(folders)},
+                    ],
+                    model=self.TEXT_MODEL_NAME,
+                    stream=False,
+                    temperature=0,
+                )
+                result = chat_completion.choices[0].message.content
+                metrics.observe_llm_call("name_folders", key, time.perf_counter() - start, chat_completion.usage)
+                # case when llm doesn't support llama json template
+                result = result.replace("```json", "").replace("```", "").strip()
+                names = {int(folder["id"]): folder["name"] for folder in json.loads(result)["folders"]}
+                break
+            except Exception as e:
+                logger.error("Error {}".format(e))
+                attempt += 1
+                metrics.observe_llm_error("name_folders", key, e, retried=attempt < 10, counted_by_hooks=True)
+                self.cnt_txt += 1
+                await asyncio.sleep(2)
+        return names  # Folders without a name are named locally
+
 
 class CustomFormatter(logging.Formatter):
     grey = "\x1b[38;5;15m"
@@ -0,0 +1,269 @@
+"""
+Export and import of the Chroma collections, so that a new node can load an index built elsewhere
+instead of parsing and embedding the whole corpus again. Run from the backend folder:
+
+    python -m app.snapshots export file_embeddings snapshots/full
+    python -m app.snapshots export file_embeddings snapshots/delta-1 --since snapshots/full
+    python -m app.snapshots import snapshots/full snapshots/delta-1
+
+A snapshot is a folder holding a manifest.json (collection, shards and their settings, checksums of the
+other files), embeddings.npy (one row per record, float32 or float16), records.jsonl.gz (id, shard,
+document and metadata of each row) and state.json.gz (hash of every record of the collection, used to
+compute the next incremental snapshot). Imported records are also added to the lexical index. An incremental snapshot only holds the records added or changed
+since the snapshot given with --since, and the ids of the records deleted since then.
+Collections must not be written to while they are exported.
+"""
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+from . import compaction
+from . import rag_utils
+from .database import get_thread_db
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+
+def record_hash(document, metadata):
+    return hashlib.sha256(json.dumps([document, metadata], sort_keys=True).encode()).hexdigest()
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def read_state(snapshot_dir):
+    with gzip.open(os.path.join(snapshot_dir, "state.json.gz"), "rt") as f:
+        return {(shard, record_id): record_hash_ for shard, record_id, record_hash_ in json.load(f)}
+
+
+def read_manifest(snapshot_dir):
+    with open(os.path.join(snapshot_dir, "manifest.json")) as f:
+        return json.load(f)
+
+
+def iter_pages(collection, include, batch_size):
+    for start in range(0, collection.count(), batch_size):
+        yield collection.get(include=include, limit=batch_size, offset=start)
+
+
+def export_snapshot(collection_name, output_dir, since=None, float16=False, chroma_path="chroma_db",
+                    batch_size=1000):
+    """
+    Exports a logical collection and all its shards to output_dir, entirely or, with since, only the
+    changes made after the snapshot in that folder. Returns the manifest.
+    """
+    client = rag_utils.get_chroma_client(path=chroma_path)
+    previous_state = read_state(since) if since else None
+    previous_manifest = read_manifest(since) if since else None
+    if previous_manifest and previous_manifest["collection"] != collection_name:
+        raise ValueError(f"{since} is a snapshot of {previous_manifest['collection']}, not {collection_name}")
+    os.makedirs(output_dir, exist_ok=False)
+
+    shard_names = rag_utils.list_shards(client, collection_name)
+    shards = {name: client.get_collection(name) for name in shard_names}
+    state = {}
+    changed = {}
+    if previous_state is not None:
+        # Documents and metadata are enough to find the changes, embeddings are only read for those
+        for name, collection in shards.items():
+            for page in iter_pages(collection, ["documents", "metadatas"], batch_size):
+                for record_id, document, metadata in zip(page["ids"], page["documents"], page["metadatas"]):
+                    key = (name, record_id)
+                    state[key] = record_hash(document, metadata)
+                    if previous_state.get(key) != state[key]:
+                        changed.setdefault(name, []).append(record_id)
+        deleted = [list(key) for key in previous_state if key not in state]
+        count = sum(len(ids) for ids in changed.values())
+    else:
+        deleted = []
+        count = sum(collection.count() for collection in shards.values())
+
+    def pages():
+        include = ["documents", "metadatas", "embeddings"]
+        for name, collection in shards.items():
+            if previous_state is None:
+                for page in iter_pages(collection, include, batch_size):
+                    for record_id, document, metadata in zip(page["ids"], page["documents"], page["metadatas"]):
+                        state[(name, record_id)] = record_hash(document, metadata)
+                    yield name, page
+            else:
+                ids = changed.get(name, [])
+                for start in range(0, len(ids), batch_size):
+                    yield name, collection.get(ids=ids[start:start + batch_size], include=include)
+
+    embeddings_path = os.path.join(output_dir, "embeddings.npy")
+    embeddings = None
+    row = 0
+    with gzip.open(os.path.join(output_dir, "records.jsonl.gz"), "wt") as records:
+        for name, page in pages():
+            page_embeddings = np.asarray(page["embeddings"], dtype=np.float16 if float16 else np.float32)
+            if embeddings is None:
+                embeddings = np.lib.format.open_memmap(
+                    embeddings_path, mode="w+", dtype=page_embeddings.dtype, shape=(count, page_embeddings.shape[1])
+                )
+            embeddings[row:row + len(page_embeddings)] = page_embeddings
+            row += len(page_embeddings)
+            for record_id, document, metadata in zip(page["ids"], page["documents"], page["metadatas"]):
+                records.write(json.dumps({"id": record_id, "shard": name, "document": document, "metadata": metadata}) + "\n")
+    if embeddings is None:
+        np.save(embeddings_path, np.zeros((0, 0), dtype=np.float16 if float16 else np.float32))
+    else:
+        embeddings.flush()
+        del embeddings
+
+    with gzip.open(os.path.join(output_dir, "state.json.gz"), "wt") as f:
+        json.dump([[name, record_id, hash_] for (name, record_id), hash_ in state.items()], f)
+
+    projections_dir = rag_utils.projections_dir(client)
+    has_projection = compaction.get_projection(collection_name, projections_dir) is not None
+    if has_projection:
+        shutil.copyfile(compaction.projection_path(collection_name, projections_dir),
+                        os.path.join(output_dir, "projection.npz"))
+
+    files = ["embeddings.npy", "records.jsonl.gz", "state.json.gz"] + (["projection.npz"] if has_projection else [])
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "snapshot_id": uuid.uuid4().hex,
+        "base_snapshot_id": previous_manifest["snapshot_id"] if previous_manifest else None,
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "collection": collection_name,
+        "shards": {name: collection.metadata for name, collection in shards.items()},
+        "records": count,
+        "deleted": deleted,
+        "embeddings_dtype": "float16" if float16 else "float32",
+        "files": {name: file_sha256(os.path.join(output_dir, name)) for name in files},
+    }
+    with open(os.path.join(output_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    logger.info(f"Exported {count} record(s) and {len(deleted)} deletion(s) of {collection_name} to {output_dir}")
+    return manifest
+
+
+def import_snapshot(snapshot_dir, chroma_path="chroma_db", force=False, batch_size=1000):
+    """
+    Loads a snapshot into the local collections with its stored embeddings, so the embedding model is never
+    called. An incremental snapshot must be imported right after the snapshot it was computed from,
+    unless force is set. Returns the manifest.
+    """
+    manifest = read_manifest(snapshot_dir)
+    if manifest["format_version"] != FORMAT_VERSION:
+        raise ValueError(f"Unsupported snapshot format: {manifest['format_version']}")
+    for name, checksum in manifest["files"].items():
+        if file_sha256(os.path.join(snapshot_dir, name)) != checksum:
+            raise ValueError(f"Checksum mismatch for {name} in {snapshot_dir}")
+
+    collection_name = manifest["collection"]
+    marker_path = os.path.join(chroma_path, "snapshots", f"{collection_name}.json")
+    last_snapshot_id = None
+    if os.path.exists(marker_path):
+        with open(marker_path) as f:
+            last_snapshot_id = json.load(f)["snapshot_id"]
+    if manifest["base_snapshot_id"] and manifest["base_snapshot_id"] != last_snapshot_id and not force:
+        raise ValueError(f"{snapshot_dir} applies on top of snapshot {manifest['base_snapshot_id']}, "
+                         f"but the last snapshot imported into {collection_name} is {last_snapshot_id}")
+
+    client = rag_utils.get_chroma_client(path=chroma_path)
+    projections_dir = rag_utils.projections_dir(client)
+    if "projection.npz" in manifest["files"]:
+        projection_path = compaction.projection_path(collection_name, projections_dir)
+        if not os.path.exists(projection_path):
+            os.makedirs(projections_dir, exist_ok=True)
+            shutil.copyfile(os.path.join(snapshot_dir, "projection.npz"), projection_path)
+        elif file_sha256(projection_path) != manifest["files"]["projection.npz"]:
+            raise ValueError(f"{collection_name} already uses another projection of its vectors")
+
+    existing_shards = set(rag_utils.list_shards(client, collection_name))
+    deleted = {}
+    for name, record_id in manifest["deleted"]:
+        deleted.setdefault(name, []).append(record_id)
+    db = get_thread_db()
+    for name, ids in deleted.items():
+        if name in existing_shards:
+            collection = client.get_collection(name)
+            for start in range(0, len(ids), batch_size):
+                collection.delete(ids=ids[start:start + batch_size])
+            db.delete_lexical_chunks(name, ids)
+
+    embeddings = np.load(os.path.join(snapshot_dir, "embeddings.npy"), mmap_mode="r")
+    collections = {}
+
+    def upsert(rows):
+        by_shard = {}
+        for row, record in rows:
+            by_shard.setdefault(record["shard"], []).append((row, record))
+        for name, shard_rows in by_shard.items():
+            if name not in collections:
+                # The shard keeps the settings it had on the exported node (root, HNSW parameters)
+                collections[name] = rag_utils.create_collection(client, name=name, metadata=manifest["shards"].get(name))
+            collections[name].upsert(
+                ids=[record["id"] for _, record in shard_rows],
+                embeddings=np.asarray(embeddings[[row for row, _ in shard_rows]], dtype=np.float32),
+                documents=[record["document"] for _, record in shard_rows],
+                metadatas=[record["metadata"] for _, record in shard_rows],
+            )
+            db.upsert_lexical_chunks(collection_name, name, [record["id"] for _, record in shard_rows],
+                                     [record["document"] for _, record in shard_rows],
+                                     [record["metadata"] for _, record in shard_rows])
+
+    rows = []
+    with gzip.open(os.path.join(snapshot_dir, "records.jsonl.gz"), "rt") as records:
+        for row, line in enumerate(records):
+            rows.append((row, json.loads(line)))
+            if len(rows) >= batch_size:
+                upsert(rows)
+                rows = []
+    if rows:
+        upsert(rows)
+
+    os.makedirs(os.path.dirname(marker_path), exist_ok=True)
+    with open(marker_path, "w") as f:
+        json.dump({"snapshot_id": manifest["snapshot_id"], "imported_at": datetime.datetime.now(datetime.timezone.utc).isoformat()}, f)
+    logger.info(f"Imported {manifest['records']} record(s) and {len(manifest['deleted'])} deletion(s) into {collection_name}")
+    return manifest
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Export and import snapshots of the Chroma collections.")
+    parser.add_argument("--chroma-path", default="chroma_db")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Export a collection and all its shards")
+    export_parser.add_argument("collection", choices=rag_utils.COLLECTION_NAMES)
+    export_parser.add_argument("output", help="Folder of the new snapshot, must not exist")
+    export_parser.add_argument("--since", help="Previous snapshot: only export the changes made after it")
+    export_parser.add_argument("--float16", action="store_true", help="Store the embeddings as float16")
+
+    import_parser = subparsers.add_parser("import", help="Import snapshots, in order")
+    import_parser.add_argument("snapshots", nargs="+")
+    import_parser.add_argument("--force", action="store_true",
+                               help="Import an incremental snapshot even if its base was not the last one imported")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        manifest = export_snapshot(args.collection, args.output, args.since, args.float16, args.chroma_path,
+                                   args.batch_size)
+        print(json.dumps({key: manifest[key] for key in ("snapshot_id", "base_snapshot_id", "records")}, indent=2))
+    else:
+        for snapshot_dir in args.snapshots:
+            import_snapshot(snapshot_dir, args.chroma_path, args.force, args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
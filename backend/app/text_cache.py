@@ -0,0 +1,120 @@
+"""
+Cache of the text extracted from files, so that parsing PDFs or transcribing audio happens once per file content.
+Entries are keyed by the content hash of the file, the version of the readers and the kind of text: the full
+pages used for indexing, or the text sent to the LLM for the summary, already truncated. They are stored
+compressed in the extracted_text table, so changing the summary model or prompt never extracts files again.
+"""
+import hashlib
+import json
+import logging
+
+import llama_index.core
+from llama_index.core import Document, SimpleDirectoryReader
+from llama_index.core.schema import ImageDocument
+
+from .database import get_thread_db
+from . import metrics
+from . import profiling
+
+logger = logging.getLogger(__name__)
+
+# Text extracted by another version of the readers is extracted again
+READER_VERSION = f"llama-index-{llama_index.core.__version__}"
+# Full text of each page, used for indexing
+PAGES = "pages"
+
+
+def summary_kind(max_tokens):
+    """Kind of the text sent to the LLM for the summary, truncated to max_tokens."""
+    return f"summary_{max_tokens}"
+
+
+def get_file_hash(file_path):
+    with metrics.HASH_SECONDS.time():
+        hash_func = hashlib.new('sha256')
+        with open(file_path, 'rb') as f:
+            while chunk := f.read(8192):
+                hash_func.update(chunk)
+        return hash_func.hexdigest()
+
+
+def pack_pages(documents, file_metadata):
+    """
+    Serializes the pages of a file. Only their text and the metadata the reader adds to each page
+    (e.g. page_label) are kept: file metadata depends on the path and is computed again when loading.
+    """
+    return json.dumps([
+        {"text": document.text, "metadata": {key: value for key, value in document.metadata.items()
+                                             if key not in file_metadata}}
+        for document in documents
+    ])
+
+
+def unpack_pages(content, file_metadata):
+    return [Document(text=page["text"], metadata={**file_metadata, **page["metadata"]}) for page in json.loads(content)]
+
+
+def extract_file(reader: SimpleDirectoryReader, input_file):
+    """Reads one of the input files of reader, the same way reader.iter_data() does."""
+    documents = SimpleDirectoryReader.load_file(
+        input_file=input_file,
+        file_metadata=reader.file_metadata,
+        file_extractor=reader.file_extractor,
+        filename_as_id=reader.filename_as_id,
+        encoding=reader.encoding,
+        errors=reader.errors,
+        raise_on_error=reader.raise_on_error,
+        fs=reader.fs,
+    )
+    return reader._exclude_metadata(documents)
+
+
+def iter_documents(reader: SimpleDirectoryReader, kind=PAGES, prepare=None):
+    """
+    Yields the hash and the documents of each input file of reader, like reader.iter_data(), but reads their
+    text from the cache when the same content was already extracted. prepare turns the pages of a file into
+    the documents cached under kind (e.g. a single truncated document for summaries), or an empty list when
+    they can't be built; when kind is missing but the pages are cached, it is derived from them without
+    extracting the file. Images are never cached, they are sent to the vision model as they are.
+    """
+    # Files are read in worker threads
+    db = get_thread_db()
+    for input_file in reader.input_files:
+        file_path = str(input_file)
+        try:
+            file_hash = get_file_hash(file_path)
+        except OSError as e:
+            logger.warning(f"Could not read {file_path}: {e}")
+            continue
+        file_metadata = reader.file_metadata(file_path)
+
+        content = db.get_extracted_text(file_hash, READER_VERSION, kind)
+        if content is None and kind != PAGES:
+            pages = db.get_extracted_text(file_hash, READER_VERSION, PAGES)
+            if pages is not None:
+                documents = prepare(reader._exclude_metadata(unpack_pages(pages, file_metadata)))
+                if documents:
+                    content = pack_pages(documents, file_metadata)
+                    db.insert_extracted_text(file_hash, READER_VERSION, kind, content)
+        if content is not None:
+            metrics.TEXT_CACHE_HITS.inc()
+            yield file_hash, reader._exclude_metadata(unpack_pages(content, file_metadata))
+            continue
+
+        metrics.TEXT_CACHE_MISSES.inc()
+        profiling.count("extracted_files")
+        with metrics.FILE_READ_SECONDS.time():
+            pages = extract_file(reader, input_file)
+        if not pages:
+            continue
+        if any(isinstance(page, ImageDocument) for page in pages):
+            yield file_hash, pages
+            continue
+        db.insert_extracted_text(file_hash, READER_VERSION, PAGES, pack_pages(pages, file_metadata))
+        if kind == PAGES:
+            yield file_hash, pages
+            continue
+        documents = prepare(pages)
+        if documents:
+            db.insert_extracted_text(file_hash, READER_VERSION, kind, pack_pages(documents, file_metadata))
+            yield file_hash, documents
@@ -0,0 +1,305 @@
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import time
+
+from . import rag_utils
+from .database import get_thread_db
+from .run import db, summarize_files, remove_deleted_files, get_file_hash
+from .settings import Settings
+
+logger = logging.getLogger(__name__)
+
+# Constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify:
+    """Minimal ctypes binding of the Linux inotify API."""
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def is_under(path, directory):
+    return path == directory or path.startswith(os.path.join(directory, ""))
+
+
+def rebase_path(path, old_path, new_path):
+    if is_under(path, old_path):
+        return new_path + path[len(old_path):]
+    return path
+
+
+def files_to_process(paths, skip_cached):
+    """
+    Runs in a worker thread: keeps the paths which are still files and, with skip_cached, whose content
+    changed since they were summarized. Files that were only touched still match their cached hash.
+    """
+    paths = [path for path in paths if os.path.isfile(path)]
+    if not skip_cached:
+        return paths
+    db = get_thread_db()
+    return [path for path in paths if not db.is_file_exist(path, get_file_hash(path))]
+
+
+class FileWatcher:
+    """
+    Watches folders with inotify and keeps the summary cache and the Chroma collections up to date.
+    Events are debounced, then only the created, modified, moved and deleted files are processed.
+    """
+
+    def __init__(self, roots: list, required_exts: list, recursive: bool = True, debounce_seconds: float = 2.0,
+                 summarize: bool = True, index: bool = True, use_advanced_indexing: bool = False):
+        self.roots = [os.path.normpath(root) for root in roots]
+        self.required_exts = required_exts
+        self.recursive = recursive
+        self.debounce_seconds = debounce_seconds
+        self.summarize = summarize
+        self.index = index
+        self.use_advanced_indexing = use_advanced_indexing
+        self.inotify = None
+        self.watches = {}
+        self.changed = set()
+        self.deleted = set()
+        self.renames = []
+        self.created_directories = set()
+        self.moved_from = {}
+        self.overflowed = False
+        self._first_event = None
+        self._last_event = None
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    @classmethod
+    def from_settings(cls, settings: Settings):
+        return cls(
+            roots=settings.WATCH_ROOTS,
+            required_exts=settings.WATCH_EXTS,
+            recursive=settings.WATCH_RECURSIVE,
+            debounce_seconds=settings.WATCH_DEBOUNCE_SECONDS,
+            summarize=settings.WATCH_SUMMARIZE,
+            index=settings.WATCH_INDEX,
+            use_advanced_indexing=settings.WATCH_ADVANCED_INDEXING,
+        )
+
+    async def start(self):
+        self.inotify = Inotify()
+        for root in self.roots:
+            self.add_directory(root)
+        asyncio.get_running_loop().add_reader(self.inotify.fd, self._on_readable)
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Watching {len(self.watches)} folder(s) under {', '.join(self.roots)}")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+        if self.inotify:
+            asyncio.get_running_loop().remove_reader(self.inotify.fd)
+            self.inotify.close()
+            self.inotify = None
+
+    def add_directory(self, path):
+        for dirpath, _, _ in os.walk(path):
+            try:
+                self.watches[self.inotify.add_watch(dirpath)] = dirpath
+            except OSError as e:
+                # ENOSPC means fs.inotify.max_user_watches is too low for this tree
+                logger.error(f"Cannot watch {dirpath}: {e}")
+            if not self.recursive:
+                break
+
+    def is_watched_file(self, path):
+        filename = os.path.basename(path)
+        return not filename.startswith(('~$', '.')) and any(path.endswith(ext) for ext in self.required_exts)
+
+    def _on_readable(self):
+        for wd, mask, cookie, name in self.inotify.read_events():
+            self._handle_event(wd, mask, cookie, name)
+        now = time.monotonic()
+        self._first_event = self._first_event or now
+        self._last_event = now
+        self._wakeup.set()
+
+    def _handle_event(self, wd, mask, cookie, name):
+        if mask & IN_Q_OVERFLOW:
+            self.overflowed = True
+            return
+        directory = self.watches.get(wd)
+        if directory is None:
+            return
+        if mask & IN_IGNORED:
+            del self.watches[wd]
+            return
+        path = os.path.join(directory, name)
+        is_dir = bool(mask & IN_ISDIR)
+
+        if mask & IN_MOVED_FROM:
+            # Paired with the IN_MOVED_TO event carrying the same cookie, otherwise the file left the tree
+            self.moved_from[cookie] = (path, is_dir)
+        elif mask & IN_MOVED_TO:
+            source = self.moved_from.pop(cookie, None)
+            if source:
+                self._record_move(source[0], path, is_dir)
+            else:
+                self._record_created(path, is_dir)
+        elif mask & IN_CREATE:
+            # Files are picked up once written (IN_CLOSE_WRITE), only new folders need a watch now
+            if is_dir:
+                self._record_created(path, is_dir)
+        elif mask & IN_CLOSE_WRITE:
+            self.changed.add(path)
+            self.deleted.discard(path)
+        elif mask & IN_DELETE and not is_dir:
+            self.deleted.add(path)
+            self.changed.discard(path)
+
+    def _record_created(self, path, is_dir):
+        if not is_dir:
+            self.changed.add(path)
+            self.deleted.discard(path)
+        elif self.recursive:
+            # Watched and scanned in a thread by flush, a large copy must not block the event loop
+            self.created_directories.add(path)
+
+    def scan_directory(self, path):
+        """
+        Runs in a worker thread: watches a new folder and its subfolders, then lists the files they hold,
+        which may have been written before the watches were added.
+        """
+        self.add_directory(path)
+        return [os.path.join(dirpath, filename) for dirpath, _, filenames in os.walk(path) for filename in filenames]
+
+    def _record_move(self, old_path, new_path, is_dir):
+        if is_dir:
+            # The watch descriptors follow the moved folder, only their paths change
+            # Snapshot: flush may add watches from its scanning thread meanwhile
+            for wd, directory in list(self.watches.items()):
+                self.watches[wd] = rebase_path(directory, old_path, new_path)
+            self.created_directories = {rebase_path(path, old_path, new_path) for path in self.created_directories}
+        self.changed = {rebase_path(path, old_path, new_path) for path in self.changed}
+        self.deleted = {rebase_path(path, old_path, new_path) for path in self.deleted}
+        self.renames.append((old_path, new_path, is_dir))
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            # Wait until events stop for debounce_seconds, but never longer than ten debounce periods
+            while True:
+                now = time.monotonic()
+                delay = min(self._last_event + self.debounce_seconds,
+                            self._first_event + 10 * self.debounce_seconds) - now
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            self._wakeup.clear()
+            self._first_event = None
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error while processing file changes: {e}")
+
+    async def flush(self):
+        renames, changed, deleted = self.renames, self.changed, self.deleted
+        created_directories = self.created_directories
+        moved_away = list(self.moved_from.values())
+        overflowed = self.overflowed
+        self.renames, self.changed, self.deleted, self.moved_from = [], set(), set(), {}
+        self.created_directories = set()
+        self.overflowed = False
+
+        for path in created_directories:
+            changed.update(await asyncio.to_thread(self.scan_directory, path))
+
+        for old_path, new_path, is_dir in renames:
+            if is_dir:
+                moves = {path: rebase_path(path, old_path, new_path) for path in db.get_files_under(old_path)}
+            else:
+                moves = {old_path: new_path}
+                # Nothing to move when the old name was never processed, e.g. a .part download renamed
+                # when complete: the file is processed under its new name, unless it is cached already
+                if db.get_file_summary(old_path) is None:
+                    changed.add(new_path)
+            db.move_files(moves)
+            await asyncio.to_thread(rag_utils.rename_file_paths, moves)
+
+        for path, is_dir in moved_away:
+            if is_dir:
+                deleted.update(db.get_files_under(path))
+                for wd, directory in list(self.watches.items()):
+                    if is_under(directory, path):
+                        self.inotify.rm_watch(wd)
+            else:
+                deleted.add(path)
+        if deleted:
+            deleted = list(deleted)
+            db.delete_records(deleted)
+            await asyncio.to_thread(rag_utils.delete_file_chunks, deleted)
+
+        if overflowed:
+            # Some events were dropped by the kernel, so everything is checked again
+            logger.warning("inotify event queue overflowed, rescanning watched folders")
+            for root in self.roots:
+                await remove_deleted_files(root, self.recursive)
+                changed.update(await asyncio.to_thread(
+                    rag_utils.list_files_to_index, root, self.recursive, self.required_exts
+                ))
+
+        changed = [path for path in changed if self.is_watched_file(path)]
+        # Hashing large files would block the event loop, and every request with it
+        changed = await asyncio.to_thread(files_to_process, changed, self.summarize)
+        if not changed:
+            return
+        if self.summarize:
+            logger.info(f"Processing {len(changed)} changed file(s)")
+            await summarize_files(changed)
+        if self.index:
+            await asyncio.to_thread(rag_utils.index_files, changed, self.use_advanced_indexing, True, self.roots)
@@ -0,0 +1,212 @@
+"""
+Benchmarks of the indexing and retrieval hot paths on a deterministic synthetic corpus.
+
+Run from the backend folder:
+
+    python -m benchmarks.bench --sizes 100,1000 --output results.json
+    python -m benchmarks.bench --sizes 100,1000 --baseline results.json
+
+Each (pipeline, corpus size) case runs in a fresh process, so that peak RSS and caches are not shared.
+"""
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from .corpus import FORMATS, generate_corpus, generate_queries
+
+# Metrics compared against the baseline, and whether higher is better
+COMPARED_METRICS = {
+    "chunks_per_second": True,
+    "parse_seconds": False,
+    "chunk_seconds": False,
+    "embed_seconds": False,
+    "upsert_seconds": False,
+    "peak_rss_mb": False,
+    "query_p50_ms": False,
+    "query_p95_ms": False,
+    "query_p99_ms": False,
+}
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, round(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+def run_case(case):
+    """Indexes a generated corpus with one pipeline and measures each stage. Runs in a child process."""
+    from llama_index.core import SimpleDirectoryReader
+    from app import rag_utils
+
+    work_dir = tempfile.mkdtemp(prefix="filewizard_bench_")
+    try:
+        corpus_dir = os.path.join(work_dir, "corpus")
+        generate_corpus(corpus_dir, case["files"], case["size_kb"], case["formats"], case["seed"])
+        file_paths = rag_utils.list_files_to_index(corpus_dir, True, [f".{ext}" for ext in case["formats"]])
+        queries = generate_queries(case["queries"], case["seed"])
+
+        client = rag_utils.get_chroma_client(path=os.path.join(work_dir, "chroma_db"))
+        advanced = case["pipeline"] == "advanced"
+        # The collection name selects the retrieval logic (re-ranking for the advanced collection)
+        collection = rag_utils.create_collection(
+            client, name="file_embeddings_unstructured" if advanced else "file_embeddings"
+        )
+        # Load the models before timing anything
+        rag_utils.get_model().encode(["warm up"])
+        if advanced:
+            rag_utils.get_cross_encoder().predict([["warm up", "warm up"]])
+
+        start = time.perf_counter()
+        if advanced:
+            elements = rag_utils.partition_files(file_paths)
+        else:
+            documents = SimpleDirectoryReader(input_files=file_paths, errors='warn').load_data()
+        parse_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if advanced:
+            chunks = list(rag_utils.iter_unstructured_chunks(elements))
+        else:
+            chunks = list(rag_utils.iter_document_chunks(documents))
+        chunk_seconds = time.perf_counter() - start
+
+        embed_seconds = 0.0
+        upsert_seconds = 0.0
+        batches = rag_utils.embed_batches(rag_utils.iter_batches(chunks))
+        while True:
+            start = time.perf_counter()
+            batch = next(batches, None)
+            embed_seconds += time.perf_counter() - start
+            if batch is None:
+                break
+            ids, documents_batch, metadatas, embeddings = batch
+            start = time.perf_counter()
+            collection.upsert(embeddings=embeddings, documents=documents_batch, metadatas=metadatas, ids=ids)
+            upsert_seconds += time.perf_counter() - start
+
+        # Retrieval part of /rag_search, without the LLM call which would only measure the provider
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            rag_utils.retrieve(query, collection, case["top_k"])
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        index_seconds = parse_seconds + chunk_seconds + embed_seconds + upsert_seconds
+        return {
+            **case,
+            "chunks": len(chunks),
+            "parse_seconds": round(parse_seconds, 4),
+            "chunk_seconds": round(chunk_seconds, 4),
+            "embed_seconds": round(embed_seconds, 4),
+            "upsert_seconds": round(upsert_seconds, 4),
+            "index_seconds": round(index_seconds, 4),
+            "chunks_per_second": round(len(chunks) / index_seconds, 2) if index_seconds else None,
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "query_p50_ms": round(percentile(latencies, 50), 3),
+            "query_p95_ms": round(percentile(latencies, 95), 3),
+            "query_p99_ms": round(percentile(latencies, 99), 3),
+            "query_mean_ms": round(statistics.fmean(latencies), 3),
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def compare(results, baseline, max_regression):
+    """Prints the relative change of each metric against the baseline. Returns False on regressions."""
+    baseline_cases = {(result["pipeline"], result["files"]): result for result in baseline["results"]}
+    ok = True
+    for result in results:
+        reference = baseline_cases.get((result["pipeline"], result["files"]))
+        if reference is None:
+            continue
+        print(f"\n{result['pipeline']} pipeline, {result['files']} files:")
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            current, previous = result.get(metric), reference.get(metric)
+            if not current or not previous:
+                continue
+            change = (current - previous) / previous
+            regression = -change if higher_is_better else change
+            flag = ""
+            if max_regression is not None and regression > max_regression:
+                flag = "  REGRESSION"
+                ok = False
+            print(f"  {metric:<20} {previous:>12} -> {current:>12} ({change:+.1%}){flag}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the indexing and retrieval hot paths.")
+    parser.add_argument("--sizes", default="100,1000", help="Comma separated corpus sizes (number of files)")
+    parser.add_argument("--size-kb", type=int, default=4, help="Approximate size of each file in KB")
+    parser.add_argument("--formats", default=",".join(FORMATS), help="Comma separated formats among txt,md,pdf")
+    parser.add_argument("--pipelines", default="standard", help="Comma separated pipelines: standard,advanced")
+    parser.add_argument("--queries", type=int, default=200, help="Number of search queries per case")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare the results with a previous JSON output")
+    parser.add_argument("--max-regression", type=float,
+                        help="Exit with an error if a metric is worse than the baseline by more than this ratio")
+    args = parser.parse_args()
+
+    cases = [
+        {
+            "pipeline": pipeline,
+            "files": int(size),
+            "size_kb": args.size_kb,
+            "formats": args.formats.split(","),
+            "queries": args.queries,
+            "top_k": args.top_k,
+            "seed": args.seed,
+        }
+        for pipeline in args.pipelines.split(",")
+        for size in args.sizes.split(",")
+    ]
+    results = []
+    for case in cases:
+        print(f"Running {case['pipeline']} pipeline on {case['files']} files...", flush=True)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1,
+                                                    mp_context=multiprocessing.get_context("spawn")) as executor:
+            result = executor.submit(run_case, case).result()
+        print(json.dumps(result, indent=2))
+        results.append(result)
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.max_regression):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
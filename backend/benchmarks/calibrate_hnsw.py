@@ -0,0 +1,171 @@
+"""
+Calibration of the HNSW parameters of a collection. Builds indexes with each combination of the grid on a
+sample of the stored embeddings, measures the recall@k against an exact (brute-force) search and the search
+latency, and suggests the cheapest settings which meet the targets.
+
+Run from the backend folder:
+
+    python -m benchmarks.calibrate_hnsw --collection file_embeddings --sample 20000 --target-latency-ms 5
+
+Without indexed data, --synthetic generates clustered random vectors instead.
+"""
+import argparse
+import itertools
+import json
+import shutil
+import tempfile
+import time
+
+import chromadb
+import numpy as np
+
+from .bench import percentile
+
+EMBEDDING_DIMENSIONS = 384
+
+
+def load_sample(chroma_path, collection_name, size, batch_size=1000):
+    """Reads up to size stored embeddings from a logical collection and its shards."""
+    from app import rag_utils
+
+    client = rag_utils.get_chroma_client(path=chroma_path)
+    vectors = []
+    remaining = size
+    for shard_name in rag_utils.list_shards(client, collection_name):
+        collection = client.get_collection(shard_name)
+        for start in range(0, min(collection.count(), remaining), batch_size):
+            records = collection.get(include=["embeddings"], limit=min(batch_size, remaining), offset=start)
+            vectors.extend(records["embeddings"])
+            remaining = size - len(vectors)
+        if remaining <= 0:
+            break
+    return np.asarray(vectors, dtype=np.float32)
+
+
+def synthetic_sample(size, dimensions=EMBEDDING_DIMENSIONS, clusters=50, seed=0):
+    """Normalized vectors around random centers, closer to sentence embeddings than uniform noise."""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dimensions))
+    vectors = centers[rng.integers(0, clusters, size)] + rng.normal(scale=0.6, size=(size, dimensions))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors.astype(np.float32)
+
+
+def exact_neighbors(vectors, queries, k, space):
+    """Exact k nearest neighbors with the distance of the Chroma space."""
+    if space == "cosine":
+        vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    if space in ("cosine", "ip"):
+        distances = -queries @ vectors.T
+    else:
+        distances = (queries ** 2).sum(axis=1)[:, None] - 2 * queries @ vectors.T + (vectors ** 2).sum(axis=1)[None, :]
+    return np.argsort(distances, axis=1)[:, :k]
+
+
+def evaluate(client, vectors, queries, truth, k, space, m, construction_ef, search_ef, batch_size=5000):
+    """Builds an index with the given parameters and measures its build time, recall@k and search latency."""
+    name = f"calibration_{m}_{construction_ef}_{search_ef}"
+    collection = client.create_collection(name=name, metadata={
+        "hnsw:space": space, "hnsw:M": m, "hnsw:construction_ef": construction_ef, "hnsw:search_ef": search_ef,
+    })
+    try:
+        start = time.perf_counter()
+        for offset in range(0, len(vectors), batch_size):
+            batch = vectors[offset:offset + batch_size]
+            collection.add(ids=[str(i) for i in range(offset, offset + len(batch))], embeddings=batch)
+        build_seconds = time.perf_counter() - start
+
+        # One query at a time, like /rag_search
+        latencies = []
+        hits = 0
+        for query, expected in zip(queries, truth):
+            start = time.perf_counter()
+            results = collection.query(query_embeddings=[query], n_results=k, include=[])
+            latencies.append((time.perf_counter() - start) * 1000)
+            hits += len({int(record_id) for record_id in results["ids"][0]} & set(expected.tolist()))
+        return {
+            "M": m,
+            "construction_ef": construction_ef,
+            "search_ef": search_ef,
+            "build_seconds": round(build_seconds, 3),
+            "recall": round(hits / (len(queries) * k), 4),
+            "latency_p50_ms": round(percentile(latencies, 50), 3),
+            "latency_p95_ms": round(percentile(latencies, 95), 3),
+        }
+    finally:
+        client.delete_collection(name)
+
+
+def suggest(results, target_recall, target_latency_ms):
+    """
+    Picks the fastest settings reaching the target recall within the target latency; otherwise the best
+    recall within the latency, and otherwise the fastest settings.
+    """
+    within_latency = [r for r in results if target_latency_ms is None or r["latency_p95_ms"] <= target_latency_ms]
+    meeting_targets = [r for r in within_latency if r["recall"] >= target_recall]
+    if meeting_targets:
+        return min(meeting_targets, key=lambda r: (r["latency_p95_ms"], r["build_seconds"]))
+    if within_latency:
+        return max(within_latency, key=lambda r: (r["recall"], -r["latency_p95_ms"]))
+    return min(results, key=lambda r: r["latency_p95_ms"])
+
+
+def parse_ints(value):
+    return [int(item) for item in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate the HNSW parameters of a collection.")
+    parser.add_argument("--chroma-path", default="chroma_db")
+    parser.add_argument("--collection", default="file_embeddings", help="Logical collection to sample")
+    parser.add_argument("--synthetic", action="store_true", help="Use generated vectors instead of stored ones")
+    parser.add_argument("--sample", type=int, default=20000, help="Number of vectors to index")
+    parser.add_argument("--queries", type=int, default=200, help="Held out vectors used as queries")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--space", default="l2", choices=["l2", "cosine", "ip"])
+    parser.add_argument("--m", default="8,16,32", help="Comma separated values of M")
+    parser.add_argument("--construction-ef", default="100,200")
+    parser.add_argument("--search-ef", default="20,50,100,200")
+    parser.add_argument("--target-recall", type=float, default=0.95)
+    parser.add_argument("--target-latency-ms", type=float, help="Maximum p95 latency of a search")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    total = args.sample + args.queries
+    if args.synthetic:
+        vectors = synthetic_sample(total, seed=args.seed)
+    else:
+        vectors = load_sample(args.chroma_path, args.collection, total)
+        if len(vectors) <= args.queries:
+            parser.error(f"Only {len(vectors)} vector(s) in {args.collection}, index files first or use --synthetic")
+    vectors = vectors[np.random.default_rng(args.seed).permutation(len(vectors))]
+    queries, vectors = vectors[:args.queries], vectors[args.queries:]
+    truth = exact_neighbors(vectors, queries, args.k, args.space)
+    print(f"Calibrating on {len(vectors)} vectors and {len(queries)} queries, recall@{args.k}, {args.space} space")
+
+    work_dir = tempfile.mkdtemp(prefix="filewizard_hnsw_")
+    results = []
+    try:
+        client = chromadb.PersistentClient(path=work_dir)
+        grid = itertools.product(parse_ints(args.m), parse_ints(args.construction_ef), parse_ints(args.search_ef))
+        for m, construction_ef, search_ef in grid:
+            result = evaluate(client, vectors, queries, truth, args.k, args.space, m, construction_ef, search_ef)
+            print(json.dumps(result), flush=True)
+            results.append(result)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    best = suggest(results, args.target_recall, args.target_latency_ms)
+    print(f"\nSuggested settings (recall {best['recall']}, p95 {best['latency_p95_ms']} ms):")
+    print(f'HNSW_COLLECTION_CONFIG={{"{args.collection}": {{"space": "{args.space}", "M": {best["M"]}, '
+          f'"construction_ef": {best["construction_ef"]}, "search_ef": {best["search_ef"]}}}}}')
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"collection": args.collection, "space": args.space, "k": args.k,
+                       "results": results, "suggested": best}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Report of the memory savings and the recall impact of compact vectors (COMPACT_VECTORS) for a collection.
+For each method and number of dimensions, the projection is fitted on a sample of the collection and the
+recall@k of an exact search in the projected space is measured against an exact search on the full vectors,
+with float32 and float16 components.
+
+Run from the backend folder:
+
+    python -m benchmarks.compact_report --collection file_embeddings --dimensions 64,128,192
+
+The full vectors are read from the collection, or computed again from the stored documents when the
+collection is already compact. Without indexed data, --synthetic generates clustered random vectors instead.
+"""
+import argparse
+import json
+
+import numpy as np
+
+from app import compaction
+from .calibrate_hnsw import EMBEDDING_DIMENSIONS, exact_neighbors, synthetic_sample
+
+
+def load_full_vectors(chroma_path, collection_name, size, batch_size=1000):
+    """Reads up to size full vectors of a logical collection, and its total number of chunks."""
+    from app import rag_utils
+
+    client = rag_utils.get_chroma_client(path=chroma_path)
+    compact = compaction.get_projection(collection_name, rag_utils.projections_dir(client)) is not None
+    include = ["documents"] if compact else ["embeddings"]
+    vectors = []
+    total = 0
+    for shard_name in rag_utils.list_shards(client, collection_name):
+        collection = client.get_collection(shard_name)
+        count = collection.count()
+        total += count
+        for start in range(0, min(count, size - len(vectors)), batch_size):
+            records = collection.get(include=include, limit=min(batch_size, size - len(vectors)), offset=start)
+            if compact:
+                vectors.extend(rag_utils.get_model().encode(records["documents"], convert_to_tensor=False))
+            else:
+                vectors.extend(records["embeddings"])
+    return np.asarray(vectors, dtype=np.float32), total
+
+
+def recall(found, expected, k):
+    return sum(len(set(f[:k]) & set(e[:k])) for f, e in zip(found.tolist(), expected.tolist())) / (len(expected) * k)
+
+
+def estimate_bytes(count, dimensions, bytes_per_value, m):
+    # Vectors plus the links of the HNSW base layer (2 * M neighbors of 4 bytes), upper layers are negligible
+    return count * (dimensions * bytes_per_value + 2 * m * 4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report memory savings and recall impact of compact vectors.")
+    parser.add_argument("--chroma-path", default="chroma_db")
+    parser.add_argument("--collection", default="file_embeddings", help="Logical collection to sample")
+    parser.add_argument("--synthetic", action="store_true", help="Use generated vectors instead of stored ones")
+    parser.add_argument("--sample", type=int, default=5000, help="Number of vectors used to fit and evaluate")
+    parser.add_argument("--queries", type=int, default=200, help="Held out vectors used as queries")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--methods", default="pca,truncate")
+    parser.add_argument("--dimensions", default="64,128,192")
+    parser.add_argument("--m", type=int, default=16, help="HNSW M, for the memory estimate")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the report to this JSON file")
+    args = parser.parse_args()
+
+    size = args.sample + args.queries
+    if args.synthetic:
+        vectors, total = synthetic_sample(size, seed=args.seed), size
+    else:
+        vectors, total = load_full_vectors(args.chroma_path, args.collection, size)
+        if len(vectors) <= args.queries:
+            parser.error(f"Only {len(vectors)} vector(s) in {args.collection}, index files first or use --synthetic")
+    vectors = vectors[np.random.default_rng(args.seed).permutation(len(vectors))]
+    queries, vectors = vectors[:args.queries], vectors[args.queries:]
+    expected = exact_neighbors(vectors, queries, args.k, "l2")
+    full_bytes = estimate_bytes(total, EMBEDDING_DIMENSIONS, 4, args.m)
+
+    rows = []
+    for method in args.methods.split(","):
+        for dimensions in [int(value) for value in args.dimensions.split(",")]:
+            projection = compaction.fit_projection(method, dimensions, vectors)
+            projected_vectors, projected_queries = projection.apply(vectors), projection.apply(queries)
+            row = {"method": method, "dimensions": projection.dimensions}
+            for dtype, bytes_per_value in (("float32", 4), ("float16", 2)):
+                found = exact_neighbors(projected_vectors.astype(dtype).astype(np.float32),
+                                        projected_queries.astype(dtype).astype(np.float32), args.k, "l2")
+                estimated = estimate_bytes(total, projection.dimensions, bytes_per_value, args.m)
+                row[dtype] = {
+                    "recall": round(recall(found, expected, args.k), 4),
+                    "estimated_mb": round(estimated / 2 ** 20, 2),
+                    "saving": round(1 - estimated / full_bytes, 4),
+                }
+            rows.append(row)
+
+    print(f"{args.collection}: {total} chunk(s), full vectors {full_bytes / 2 ** 20:.2f} MB, recall@{args.k}")
+    print(f"{'method':<10}{'dims':>6}{'recall f32':>12}{'MB f32':>10}{'saving':>9}{'recall f16':>12}{'MB f16':>10}{'saving':>9}")
+    for row in rows:
+        f32, f16 = row["float32"], row["float16"]
+        print(f"{row['method']:<10}{row['dimensions']:>6}{f32['recall']:>12}{f32['estimated_mb']:>10}{f32['saving']:>9.1%}"
+              f"{f16['recall']:>12}{f16['estimated_mb']:>10}{f16['saving']:>9.1%}")
+    print("\nChroma stores float32 vectors: the float16 columns only apply to copies of the vectors kept outside of it.")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"collection": args.collection, "chunks": total, "k": args.k,
+                       "full_estimated_mb": round(full_bytes / 2 ** 20, 2), "results": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
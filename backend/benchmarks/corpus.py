@@ -0,0 +1,135 @@
+"""
+Deterministic synthetic corpus for the benchmarks: the same seed always produces the same files,
+so that runs on different commits index exactly the same content.
+"""
+import os
+import random
+
+TOPICS = {
+    "finance": ["invoice", "payment", "budget", "expense", "receipt", "tax", "account", "balance", "refund", "ledger"],
+    "travel": ["flight", "hotel", "booking", "itinerary", "passport", "airport", "luggage", "visa", "train", "museum"],
+    "health": ["doctor", "prescription", "appointment", "vaccine", "symptom", "clinic", "insurance", "therapy", "dose"],
+    "software": ["deployment", "server", "database", "latency", "container", "pipeline", "release", "bug", "index"],
+    "cooking": ["recipe", "oven", "flour", "butter", "sauce", "garlic", "simmer", "dough", "pepper", "roast"],
+    "legal": ["contract", "clause", "agreement", "liability", "signature", "lease", "tenant", "court", "notice"],
+    "research": ["experiment", "sample", "hypothesis", "dataset", "protocol", "measurement", "analysis", "variance"],
+    "education": ["course", "lecture", "exam", "curriculum", "assignment", "grade", "semester", "certificate"],
+}
+COMMON_WORDS = ["the", "a", "of", "and", "to", "in", "for", "with", "on", "this", "that", "is", "was", "be", "by",
+                "from", "as", "at", "we", "our", "report", "document", "section", "details", "following", "summary"]
+FORMATS = ["txt", "md", "pdf"]
+
+
+def make_sentence(rng, topic_words):
+    words = [rng.choice(topic_words) if rng.random() < 0.3 else rng.choice(COMMON_WORDS)
+             for _ in range(rng.randint(8, 18))]
+    return " ".join(words).capitalize() + "."
+
+
+def make_paragraphs(rng, topic, size_bytes):
+    topic_words = TOPICS[topic]
+    paragraphs = []
+    size = 0
+    while size < size_bytes:
+        paragraph = " ".join(make_sentence(rng, topic_words) for _ in range(rng.randint(3, 7)))
+        # Exact identifiers, like the ones users search for
+        if rng.random() < 0.3:
+            paragraph += f" Reference {topic[:3].upper()}-{rng.randint(0, 999999):06d}."
+        paragraphs.append(paragraph)
+        size += len(paragraph) + 2
+    return paragraphs
+
+
+def escape_pdf_text(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def wrap(text, width=90):
+    lines, line = [], ""
+    for word in text.split():
+        if line and len(line) + len(word) + 1 > width:
+            lines.append(line)
+            line = word
+        else:
+            line = f"{line} {word}" if line else word
+    if line:
+        lines.append(line)
+    return lines
+
+
+def write_pdf(path, paragraphs, lines_per_page=50):
+    """Writes a minimal, valid PDF with one text stream per page (no external dependency)."""
+    lines = []
+    for paragraph in paragraphs:
+        lines.extend(wrap(paragraph))
+        lines.append("")
+    pages = [lines[start:start + lines_per_page] for start in range(0, len(lines), lines_per_page)] or [[]]
+
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # Pages, written once the page objects are known
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_ids = []
+    for page_lines in pages:
+        text = "".join(f"({escape_pdf_text(line)}) Tj T* " for line in page_lines)
+        stream = f"BT /F1 10 Tf 13 TL 40 800 Td {text}ET".encode("latin-1", "replace")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        content_id = len(objects)
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id)
+        page_ids.append(len(objects))
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids).encode()
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_ids))
+
+    data = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref_offset = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    data += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    data += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_offset)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def write_document(path, file_format, topic, paragraphs):
+    if file_format == "pdf":
+        write_pdf(path, paragraphs)
+        return
+    if file_format == "md":
+        paragraphs = [f"# {topic.capitalize()} notes"] + [
+            f"## Section {index}\n\n{paragraph}" if index % 3 == 0 else paragraph
+            for index, paragraph in enumerate(paragraphs)
+        ]
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n\n".join(paragraphs))
+
+
+def generate_corpus(output_dir, file_count, size_kb=4, formats=FORMATS, seed=0):
+    """Generates file_count files of about size_kb each, spread over topic folders. Returns the file paths."""
+    file_paths = []
+    topics = sorted(TOPICS)
+    for index in range(file_count):
+        rng = random.Random(f"{seed}-{index}")
+        topic = topics[index % len(topics)]
+        file_format = formats[index % len(formats)]
+        folder = os.path.join(output_dir, topic)
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"{topic}_{index:06d}.{file_format}")
+        write_document(path, file_format, topic, make_paragraphs(rng, topic, size_kb * 1024))
+        file_paths.append(path)
+    return file_paths
+
+
+def generate_queries(count, seed=0):
+    """Generates search queries mixing topic words, deterministic for a given seed."""
+    rng = random.Random(f"queries-{seed}")
+    topics = sorted(TOPICS)
+    queries = []
+    for _ in range(count):
+        topic = rng.choice(topics)
+        queries.append(" ".join(rng.sample(TOPICS[topic], 3)))
+    return queries
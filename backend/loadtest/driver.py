@@ -0,0 +1,159 @@
+"""
+Load driver for the app endpoints. Fires /get_files, /rag_search or /index_files requests at a
+target concurrency and reports throughput, tail latency and, when the fake OpenAI server is used,
+the number of LLM calls, errors and retries behind each request. LLM calls are counted by the fake
+server itself: they include the requests the OpenAI SDK retries with backoff before the app's own retry
+loops, which the app counts in filewizard_llm_retries_total through the HTTP hooks of its clients.
+
+    python -m loadtest.fake_openai --port 9000 --rate-429 0.05 &
+    uvicorn app.server:app --port 8000 &
+    python -m loadtest.driver --scenario rag_search --concurrency 16 --requests 500 --fake-url http://localhost:9000
+
+Summaries are cached, so /get_files only exercises the LLM on files it has never seen: use
+--generate-corpus to run on a fresh synthetic corpus (the app must run on the same machine).
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.corpus import generate_corpus, generate_queries
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, round(percent / 100 * len(values)) - 1))
+    return round(values[index], 3)
+
+
+def build_request(scenario, args, query):
+    if scenario == "get_files":
+        return "GET", "/get_files", {"params": {
+            "root_path": args.root_path, "recursive": "true", "required_exts": args.required_exts
+        }}
+    if scenario == "index_files":
+        return "POST", "/index_files", {"json": {
+            "root_path": args.root_path, "recursive": True, "required_exts": args.required_exts,
+            "use_advanced_indexing": args.advanced
+        }}
+    collection_name = "file_embeddings_unstructured" if args.advanced else "file_embeddings"
+    return "GET", "/rag_search", {"params": {"query": query, "collection_name": collection_name, "top_k": args.top_k}}
+
+
+async def fetch_fake_stats(client, fake_url):
+    if not fake_url:
+        return None
+    response = await client.get(f"{fake_url}/stats")
+    return response.json()["total"]
+
+
+async def run_load(args, queries):
+    scenarios = args.scenario.split(",")
+    request_numbers = itertools.count()
+    latencies = {scenario: [] for scenario in scenarios}
+    errors = {scenario: 0 for scenario in scenarios}
+    deadline = time.monotonic() + args.duration if args.duration else None
+
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout) as client:
+        if args.fake_url:
+            await client.post(f"{args.fake_url}/stats/reset")
+
+        async def worker():
+            while True:
+                number = next(request_numbers)
+                if (deadline and time.monotonic() >= deadline) or (not deadline and number >= args.requests):
+                    return
+                scenario = scenarios[number % len(scenarios)]
+                method, path, kwargs = build_request(scenario, args, queries[number % len(queries)])
+                start = time.perf_counter()
+                try:
+                    response = await client.request(method, path, **kwargs)
+                    failed = response.status_code >= 400
+                except httpx.HTTPError:
+                    failed = True
+                latencies[scenario].append((time.perf_counter() - start) * 1000)
+                errors[scenario] += failed
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+        elapsed = time.perf_counter() - start
+        llm_stats = await fetch_fake_stats(client, args.fake_url)
+
+    report = {"concurrency": args.concurrency, "elapsed_seconds": round(elapsed, 3), "scenarios": {}}
+    total_requests = 0
+    for scenario in scenarios:
+        values = latencies[scenario]
+        total_requests += len(values)
+        report["scenarios"][scenario] = {
+            "requests": len(values),
+            "errors": errors[scenario],
+            "throughput_rps": round(len(values) / elapsed, 3) if elapsed else None,
+            "latency_ms": {
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+                "max": round(max(values), 3) if values else None,
+            },
+        }
+    report["throughput_rps"] = round(total_requests / elapsed, 3) if elapsed else None
+
+    if llm_stats is not None:
+        llm_requests = llm_stats.get("requests", 0)
+        llm_successes = llm_stats.get("status_200", 0)
+        # Counted by the fake server, so the 429s retried inside the OpenAI SDK are included
+        report["llm"] = {
+            "requests": llm_requests,
+            "successes": llm_successes,
+            "status_429": llm_stats.get("status_429", 0),
+            "status_5xx": llm_stats.get("status_5xx", 0),
+            "prompt_tokens": llm_stats.get("prompt_tokens", 0),
+            "completion_tokens": llm_stats.get("completion_tokens", 0),
+            "llm_calls_per_request": round(llm_requests / total_requests, 3) if total_requests else None,
+            # Every LLM request beyond the successful ones is a retry
+            "retry_amplification": round(llm_requests / llm_successes, 3) if llm_successes else None,
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the app endpoints.")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--fake-url", help="URL of loadtest.fake_openai, to account LLM calls and retries")
+    parser.add_argument("--scenario", default="rag_search",
+                        help="Comma separated endpoints to mix: get_files, rag_search, index_files")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=100, help="Total number of requests")
+    parser.add_argument("--duration", type=float, help="Run for this many seconds instead of a number of requests")
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--root-path", help="Folder used by get_files and index_files")
+    parser.add_argument("--required-exts", default=".txt;.md;.pdf")
+    parser.add_argument("--generate-corpus", type=int, metavar="FILES",
+                        help="Generate a synthetic corpus of this many files and use it as root path")
+    parser.add_argument("--advanced", action="store_true", help="Use the advanced (Unstructured) collection")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=100, help="Number of distinct generated search queries")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the report to this JSON file")
+    args = parser.parse_args()
+
+    if args.generate_corpus:
+        args.root_path = tempfile.mkdtemp(prefix="filewizard_load_")
+        generate_corpus(args.root_path, args.generate_corpus, seed=args.seed)
+    if not args.root_path and ("get_files" in args.scenario or "index_files" in args.scenario):
+        parser.error("--root-path or --generate-corpus is required for get_files and index_files")
+
+    report = asyncio.run(run_load(args, generate_queries(args.queries, args.seed)))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
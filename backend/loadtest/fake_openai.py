@@ -0,0 +1,173 @@
+"""
+Local stand-in for an OpenAI-compatible chat completions API, to load test the app offline.
+
+    python -m loadtest.fake_openai --port 9000 --latency-dist lognormal --latency-ms 800 --rate-429 0.05
+
+Then point the app to it in the .env file (any API key works, each key is accounted separately):
+
+    TEXT_API_END_POINT=http://localhost:9000/v1
+    TEXT_API_KEYS=["key-1","key-2"]
+    IMAGE_API_END_POINT=http://localhost:9000/v1
+    IMAGE_API_KEYS=["key-1"]
+"""
+import argparse
+import asyncio
+import collections
+import json
+import math
+import random
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+
+class FakeServerConfig:
+    def __init__(self, latency_dist="lognormal", latency_ms=500.0, latency_sigma=0.5, rate_429=0.0, rate_5xx=0.0,
+                 tokens_per_second=0.0, seed=0):
+        self.latency_dist = latency_dist
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.tokens_per_second = tokens_per_second
+        self.random = random.Random(seed)
+
+    def sample_latency(self):
+        """Returns a latency in seconds, with latency_ms as the mean of the distribution."""
+        mean = self.latency_ms / 1000
+        if self.latency_dist == "constant":
+            return mean
+        if self.latency_dist == "uniform":
+            return self.random.uniform(0, 2 * mean)
+        if self.latency_dist == "exponential":
+            return self.random.expovariate(1 / mean) if mean else 0
+        if not mean:
+            return 0
+        # lognormal: heavy tail like real providers, mu is chosen so that the mean is latency_ms
+        mu = math.log(mean) - self.latency_sigma ** 2 / 2
+        return self.random.lognormvariate(mu, self.latency_sigma)
+
+
+def count_tokens(text):
+    # Rough estimate, good enough for accounting
+    return max(1, len(text) // 4)
+
+
+def message_text(message):
+    content = message.get("content") or ""
+    if isinstance(content, str):
+        return content
+    # Multimodal content: only the text parts and the size of the images are accounted
+    parts = []
+    for part in content:
+        if part.get("type") == "text":
+            parts.append(part.get("text", ""))
+        elif part.get("type") == "image_url":
+            parts.append(" " * min(len(part["image_url"]["url"]), 4 * 1000))
+    return " ".join(parts)
+
+
+def fake_completion(messages):
+    """Builds an answer with the shape each prompt of settings.Model expects."""
+    user_text = message_text(messages[-1]) if messages else ""
+    try:
+        payload = json.loads(user_text)
+    except ValueError:
+        payload = None
+    if isinstance(payload, list) and payload and isinstance(payload[0], dict):
+        if "file_path" in payload[0]:
+            files = [{"src_path": item["file_path"], "dst_path": f"organized/{item['file_path']}"} for item in payload]
+            return json.dumps({"files": files})
+        if "id" in payload[0]:
+            return json.dumps({"folders": [{"id": item["id"], "name": f"folder_{item['id']}"} for item in payload]})
+    words = user_text.split()
+    return "Summary: " + " ".join(words[:40])
+
+
+def create_app(config: FakeServerConfig):
+    app = FastAPI()
+    stats = collections.defaultdict(lambda: collections.Counter())
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        key = request.headers.get("authorization", "").removeprefix("Bearer ") or "anonymous"
+        key_stats = stats[key]
+        key_stats["requests"] += 1
+        prompt_tokens = sum(count_tokens(message_text(message)) for message in body.get("messages", []))
+
+        await asyncio.sleep(config.sample_latency())
+        draw = config.random.random()
+        if draw < config.rate_429:
+            key_stats["status_429"] += 1
+            return JSONResponse(
+                status_code=429,
+                headers={"retry-after-ms": "200"},
+                content={"error": {"message": "Rate limit reached", "type": "rate_limit_exceeded", "code": 429}},
+            )
+        if draw < config.rate_429 + config.rate_5xx:
+            key_stats["status_5xx"] += 1
+            return JSONResponse(
+                status_code=503,
+                content={"error": {"message": "Service unavailable", "type": "server_error", "code": 503}},
+            )
+
+        content = fake_completion(body.get("messages", []))
+        completion_tokens = count_tokens(content)
+        if config.tokens_per_second:
+            await asyncio.sleep(completion_tokens / config.tokens_per_second)
+        key_stats["status_200"] += 1
+        key_stats["prompt_tokens"] += prompt_tokens
+        key_stats["completion_tokens"] += completion_tokens
+        return {
+            "id": f"chatcmpl-fake-{key_stats['requests']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    @app.get("/stats")
+    async def get_stats():
+        total = collections.Counter()
+        for key_stats in stats.values():
+            total.update(key_stats)
+        return {"total": dict(total), "keys": {key: dict(key_stats) for key, key_stats in stats.items()}}
+
+    @app.post("/stats/reset")
+    async def reset_stats():
+        stats.clear()
+        return {"message": "Stats reset"}
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible server for offline load tests.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency-dist", choices=["constant", "uniform", "exponential", "lognormal"],
+                        default="lognormal")
+    parser.add_argument("--latency-ms", type=float, default=500.0, help="Mean latency of a completion")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Sigma of the lognormal distribution")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Ratio of requests answered with a 429")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="Ratio of requests answered with a 503")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0,
+                        help="Generation speed added to the latency (0 to disable)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    import uvicorn
+    config = FakeServerConfig(args.latency_dist, args.latency_ms, args.latency_sigma, args.rate_429, args.rate_5xx,
+                              args.tokens_per_second, args.seed)
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()